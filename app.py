@@ -1,14 +1,23 @@
+import atexit
 import logging
+import logging.handlers
+import queue
 import time
 import json
+import hashlib
+import uuid
 import os
 import shutil
+import sys
 import tempfile
 import subprocess
 import signal
-from threading import Lock
+from threading import BoundedSemaphore, Event, Lock
+from contextlib import ExitStack
+from collections import OrderedDict
+from functools import lru_cache
 from datetime import datetime, timedelta
-from pytz import timezone
+from pytz import timezone, utc
 import re
 
 # Patch eventlet to support asynchronous operations
@@ -16,42 +25,224 @@ import eventlet
 eventlet.monkey_patch()
 
 # Flask-related imports
-from flask import Flask, request, jsonify
+from flask import Flask, Request, request, jsonify
 from flask_cors import CORS
 from flask_socketio import SocketIO, emit
+from werkzeug.exceptions import RequestEntityTooLarge
 
 # Facebook Ads SDK
 from facebook_business.api import FacebookAdsApi
+from facebook_business.session import FacebookSession
 from facebook_business.adobjects.adaccount import AdAccount
 from facebook_business.adobjects.adset import AdSet
 from facebook_business.adobjects.adcreative import AdCreative
-from facebook_business.adobjects.ad import Ad
 from facebook_business.adobjects.advideo import AdVideo
 from facebook_business.adobjects.adimage import AdImage
 from facebook_business.adobjects.campaign import Campaign
+from facebook_business.adobjects.videothumbnail import VideoThumbnail
 
 # External libraries
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 from PIL import Image
 
 # Concurrency tools
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import CancelledError, ThreadPoolExecutor, as_completed, wait
 
 # Flask app setup
 app = Flask(__name__)
 CORS(app)
 socketio = SocketIO(app, cors_allowed_origins="*")
 
+# Logging setup: records are queued and written to stderr by a listener thread,
+# so worker threads never block on the stream
+log_queue = queue.Queue(-1)
+logging.basicConfig(
+    level=os.environ.get('LOG_LEVEL', 'INFO').upper(),
+    format='%(asctime)s %(levelname)s %(message)s',
+    handlers=[logging.handlers.QueueHandler(log_queue)],
+)
+log_listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+log_listener.start()
+atexit.register(log_listener.stop)
+
+# Thread-safe mapping that keeps only its maxsize most recently used entries
+class LRUCache:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                return self.entries[key]
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
 # Global variables for tasks and locks
 upload_tasks = {}
 tasks_lock = Lock()
-process_pids = {}
-canceled_tasks = set()
+# ffmpeg/ffprobe processes still running per task, so a cancel can terminate them
+task_processes = {}
+# Set once a task is canceled; checked without taking tasks_lock
+cancel_events = {}
+
+# Number of ads processed concurrently across all tasks. eventlet turns the pool's
+# threads into green threads, so this bounds Graph API concurrency, not OS threads
+MAX_WORKERS = int(os.environ.get('ADS_WORKERS', 32))
+
+# Shared by every task so worker threads are reused instead of spawned per ad set
+EXECUTOR = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+# Ad set creation and carousel card preparation, which run while ads and carousels on EXECUTOR
+# wait for them. Kept apart from EXECUTOR so those waiters can never starve the pool the work runs on
+IO_WORKERS = int(os.environ.get('ADS_IO_WORKERS', 16))
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS)
+
+# How long an uploaded video may take to become ready, and the longest wait between status checks
+VIDEO_READY_TIMEOUT = 100
+VIDEO_READY_MAX_DELAY = 16
+
+# Size of the HTTP connection pool shared by all Graph API calls
+HTTP_POOL_SIZE = 50
+
+# Distinct credentials whose SDK API objects are kept for reuse
+GRAPH_API_CACHE_SIZE = 32
+facebook_apis = LRUCache(GRAPH_API_CACHE_SIZE)
+
+# Ad accounts whose timezone is remembered
+AD_ACCOUNT_TIMEZONE_CACHE_SIZE = 128
+ad_account_timezones = LRUCache(AD_ACCOUNT_TIMEZONE_CACHE_SIZE)
+
+# One transport adapter for every SDK session, so TLS connections to graph.facebook.com are
+# reused across tasks and requests. pool_block makes callers wait for an idle connection
+# instead of opening extra ones that are thrown away after a single call.
+# Rate limits and server errors are retried with exponential backoff; urllib3 only retries those
+# for idempotent methods, so a POST that may already have created an object is never repeated
+GRAPH_RETRY = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+GRAPH_ADAPTER = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE, max_retries=GRAPH_RETRY, pool_block=True)
+
+# Fields requested back from Graph API create/read calls
+CAMPAIGN_FIELDS = [AdAccount.Field.id]
+AD_SET_FIELDS = [AdSet.Field.name]
+TIMEZONE_FIELDS = [AdAccount.Field.timezone_name]
+
+# Creative enhancements every ad opts out of; shared by all creatives and never mutated
+DEGREES_OF_FREEDOM_SPEC = {
+    "creative_features_spec": {
+        "standard_enhancements": {
+            "enroll_status": "OPT_OUT"  # explicitly opting out
+        }
+    }
+}
+
+# Form placement keys and the Graph API position each one adds, per publisher platform
+FACEBOOK_PLACEMENTS = (
+    ('profile_feed', 'profile_feed'),
+    ('marketplace', 'marketplace'),
+    ('video_feeds', 'video_feeds'),
+    ('right_column', 'right_hand_column'),
+    ('stories', 'story'),
+    ('reels', 'facebook_reels'),
+    ('in_stream', 'instream_video'),
+    ('search', 'search'),
+    ('facebook_reels', 'facebook_reels'),
+)
+INSTAGRAM_PLACEMENTS = (
+    ('instagram_feeds', 'stream'),
+    ('instagram_profile_feed', 'profile_feed'),
+    ('explore', 'explore'),
+    ('explore_home', 'explore_home'),
+    ('instagram_stories', 'story'),
+    ('instagram_reels', 'reels'),
+    ('instagram_search', 'ig_search'),
+)
+AUDIENCE_NETWORK_PLACEMENTS = (
+    ('native_banner_interstitial', 'classic'),
+    ('rewarded_videos', 'rewarded_video'),
+)
+
+# Task settings copied straight from the create_campaign form: config key -> (form field, default)
+CONFIG_FORM_FIELDS = {
+    'headline': ('headline', 'No More Neuropathic Foot Pain'),
+    'link': ('destination_url', 'https://kyronaclinic.com/pages/review-1'),
+    'utm_parameters': ('url_parameters', '?utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}'),
+    'location': ('location', 'GB'),
+    'age_range': ('age_range', None),
+    'age_range_max': ('age_range_max', '65'),
+    'ad_creative_primary_text': ('ad_creative_primary_text', ''),
+    'ad_creative_headline': ('ad_creative_headline', 'No More Neuropathic Foot Pain'),
+    'ad_creative_description': ('ad_creative_description', 'FREE Shipping & 60-Day Money-Back Guarantee'),
+    'call_to_action': ('call_to_action', 'SHOP_NOW'),
+    'destination_url': ('destination_url', 'https://kyronaclinic.com/pages/review-1'),
+    'language_customizations': ('language_customizations', 'en'),
+    'url_parameters': ('url_parameters', '?utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}'),
+    'gender': ('gender', 'All'),
+    'ad_set_budget_optimization': ('ad_set_budget_optimization', 'DAILY_BUDGET'),
+    'ad_set_budget_value': ('ad_set_budget_value', '50.73'),
+    'ad_set_bid_strategy': ('ad_set_bid_strategy', 'LOWEST_COST_WITHOUT_CAP'),
+    'campaign_budget_optimization': ('campaign_budget_optimization', 'AD_SET_BUDGET_OPTIMIZATION'),
+    'ad_set_end_time': ('ad_set_end_time', ''),
+    'buying_type': ('buying_type', 'AUCTION'),
+    'geo_locations': ('location', None),
+    'optimization_goal': ('performance_goal', 'OFFSITE_CONVERSIONS'),
+    'event_type': ('event_type', 'PURCHASE'),
+    'attribution_setting': ('attribution_setting', '7d_click'),
+    'instagram_actor_id': ('instagram_account', ''),
+}
+
+# Media file extensions picked up from the uploaded folders
+VIDEO_EXTS = frozenset({'.mp4', '.mov', '.avi'})
+IMAGE_EXTS = frozenset({'.jpg', '.jpeg', '.png', '.webp'})
+
+# Number of uploaded media remembered for reuse, and bytes read from each end of a file to fingerprint it
+UPLOAD_CACHE_SIZE = 4096
+FINGERPRINT_SAMPLE_SIZE = 1 << 20
+
+# Recently uploaded media per ad account, fingerprint -> video ID or image hash
+upload_cache = LRUCache(UPLOAD_CACHE_SIZE)
+
+# Threads per ffmpeg process, and how many ffmpeg processes may run at once. Many small
+# ffmpegs with few threads each keep all cores busy without oversubscribing them
+FFMPEG_THREADS = os.environ.get('FFMPEG_THREADS', '1')
+FFMPEG_PROCESSES = int(os.environ.get('FFMPEG_PROCESSES', os.cpu_count() or 4))
+ffmpeg_slots = BoundedSemaphore(FFMPEG_PROCESSES)
+
+# ffmpeg -hwaccel method for decoding video (e.g. cuda, vaapi, qsv); unset decodes on the CPU
+FFMPEG_HWACCEL = os.environ.get('FFMPEG_HWACCEL', '')
+
+# Where generated thumbnails are written; /dev/shm keeps the write and the upload's read in memory
+THUMBNAIL_TMP_DIR = os.environ.get('FB_THUMBNAIL_TMP', '/dev/shm')
+
+# Buffer size for copying uploaded files to disk
+COPY_BUFFER_SIZE = 1 << 20
+
+# Optional staging directory for uploads, e.g. /dev/shm to keep media in RAM for ffmpeg and the SDK
+UPLOAD_TMP_DIR = os.environ.get('FB_UPLOAD_TMP')
+
+# Optional cap on a request body in bytes. Werkzeug rejects larger uploads before spooling them to disk
+if os.environ.get('FB_MAX_UPLOAD_BYTES'):
+    app.config['MAX_CONTENT_LENGTH'] = int(os.environ['FB_MAX_UPLOAD_BYTES'])
 
 # Custom Exception for canceled tasks
 class TaskCanceledException(Exception):
     pass
 
+# Emit an event and yield to the eventlet hub, so it is written to the client now
+# instead of queuing behind whatever the calling thread does next
+def emit_now(event, data):
+    socketio.emit(event, data)
+    socketio.sleep(0)
+
 # Utility function to handle error emission through socket
 def emit_error(task_id, message):
     logging.error(f"Raw error message: {message}")  # Log the full raw message for debugging purposes
@@ -70,8 +261,7 @@ def emit_error(task_id, message):
 
             # Step 3: Extract title and message from the parsed JSON
             title = error_data.get("error", {}).get("error_user_title", "Error")
-            print("Title\n")
-            print(title)
+            logging.debug(f"Error title: {title}")
             msg = error_data.get("error", {}).get("error_user_msg", "An unknown error occurred.")
         except json.JSONDecodeError:
             logging.error("Failed to parse the error JSON from the response.")
@@ -80,34 +270,62 @@ def emit_error(task_id, message):
         msg = message
 
     # Step 4: Emit the error title and message to the frontend
-    socketio.emit('error', {
+    emit_now('error', {
         'task_id': task_id,
         'title': title,
         'message': msg
     })
 
-    # Emit only the title and message to the frontend
-    socketio.emit('error', {'task_id': task_id, 'title': title, 'message': msg})
-
-# Common cancellation check
+# Common cancellation check. The event stays set, so every worker of a canceled task stops, not just the first to look
 def check_cancellation(task_id):
+    cancel_event = cancel_events.get(task_id)
+    if cancel_event is not None and cancel_event.is_set():
+        raise TaskCanceledException(f"Task {task_id} has been canceled")
+
+# A task is registered as soon as its request is being handled, so a cancel that arrives
+# while the campaign is created or the uploads are saved is kept for process_media
+def register_task(task_id):
     with tasks_lock:
-        if task_id in canceled_tasks:
-            canceled_tasks.remove(task_id)
-            raise TaskCanceledException(f"Task {task_id} has been canceled")
+        upload_tasks[task_id] = True
+        task_processes[task_id] = set()
+        cancel_events[task_id] = Event()
+
+def unregister_task(task_id):
+    with tasks_lock:
+        task_processes.pop(task_id, None)
+        upload_tasks.pop(task_id, None)
+        cancel_events.pop(task_id, None)
+
+# Build an SDK API object whose session uses GRAPH_ADAPTER, reused per set of credentials.
+# The cache is keyed on a digest so the secret and token are not kept as keys, and the
+# process-wide default API is left alone, so concurrent requests never swap each other's credentials
+def build_facebook_api(app_id, app_secret, access_token, api_version):
+    key = hashlib.blake2b('\0'.join((app_id, app_secret, access_token, api_version)).encode(), digest_size=16).hexdigest()
+    api = facebook_apis.get(key)
+    if api is None:
+        session = FacebookSession(app_id, app_secret, access_token)
+        session.requests.mount('https://', GRAPH_ADAPTER)
+        api = FacebookAdsApi(session, api_version)
+        facebook_apis.put(key, api)
+    return api
 
 #function to check campaign budget optimization.
-def get_campaign_budget_optimization(campaign_id, ad_account_id):
+# Returns None when the campaign does not belong to ad_account_id, so one request both checks ownership and reads the budget
+def get_campaign_budget_optimization(campaign_id, ad_account_id, api):
     try:
-        campaign = Campaign(campaign_id).api_get(fields=[
+        campaign = Campaign(campaign_id, api=api).api_get(fields=[
             Campaign.Field.name,
             Campaign.Field.effective_status,
             Campaign.Field.daily_budget,
             Campaign.Field.lifetime_budget,
-            Campaign.Field.objective
-
+            Campaign.Field.objective,
+            Campaign.Field.account_id,
         ])
-        
+        # A campaign of another ad account is treated as not found
+        if campaign.get('account_id') != ad_account_id.replace('act_', ''):
+            logging.error(f"Campaign ID {campaign_id} not found for ad account {ad_account_id}")
+            return None
+
         is_cbo = campaign.get('daily_budget') is not None or campaign.get('lifetime_budget') is not None
         return {
             "name": campaign.get('name'),
@@ -116,23 +334,27 @@ def get_campaign_budget_optimization(campaign_id, ad_account_id):
             "lifetime_budget": campaign.get('lifetime_budget'),
             "is_campaign_budget_optimization": is_cbo,
             "objective": campaign.get("objective", "OUTCOME_TRAFFIC"),  # Return the campaign objective
-
         }
     except Exception as e:
-        print(f"Error fetching campaign details: {e}")
+        logging.error(f"Error fetching campaign details: {e}")
         return None
 
 # Function to fetch campaign budget optimization status and return a boolean value
-def is_campaign_budget_optimized(campaign_id, ad_account_id):
-    existing_campaign_budget_optimization = get_campaign_budget_optimization(campaign_id, ad_account_id)
+def is_campaign_budget_optimized(campaign_id, ad_account_id, api):
+    existing_campaign_budget_optimization = get_campaign_budget_optimization(campaign_id, ad_account_id, api)
+    if existing_campaign_budget_optimization is None:
+        return None
     return existing_campaign_budget_optimization.get('is_campaign_budget_optimization', False)
 
+# Copy the plain form settings into a task config in one pass over CONFIG_FORM_FIELDS
+def read_form_config(form):
+    return {key: form.get(field, default) for key, (field, default) in CONFIG_FORM_FIELDS.items()}
+
 # Function to create a campaign
-def create_campaign(name, objective, budget_optimization, budget_value, bid_strategy, buying_type, task_id, ad_account_id, app_id, app_secret, access_token, is_cbo):
+def create_campaign(name, objective, budget_optimization, budget_value, bid_strategy, buying_type, task_id, ad_account_id, is_cbo, api):
     check_cancellation(task_id)
     try:
-        FacebookAdsApi.init(app_id, app_secret, access_token, api_version='v19.0')
-
+        # Uses the API the request handler built, so its pooled session is reused
         campaign_params = {
             "name": name,
             "objective": objective,
@@ -148,7 +370,7 @@ def create_campaign(name, objective, budget_optimization, budget_value, bid_stra
                 campaign_params["lifetime_budget"] = budget_value_cents if budget_optimization == "LIFETIME_BUDGET" else None
                 campaign_params["bid_strategy"] = bid_strategy
 
-        campaign = AdAccount(ad_account_id).create_campaign(fields=[AdAccount.Field.id], params=campaign_params)
+        campaign = AdAccount(ad_account_id, api=api).create_campaign(fields=CAMPAIGN_FIELDS, params=campaign_params)
         logging.info(f"Created campaign with ID: {campaign['id']}")
         return campaign['id'], campaign
     except Exception as e:
@@ -157,237 +379,185 @@ def create_campaign(name, objective, budget_optimization, budget_value, bid_stra
         return None, None
 
 #fetch ad_account timezone:
-def get_ad_account_timezone(ad_account_id):
-    ad_account = AdAccount(ad_account_id).api_get(fields=[AdAccount.Field.timezone_name])
-    return ad_account.get('timezone_name')
-
+# An account's timezone practically never changes, so it is fetched once per account per process
+def get_ad_account_timezone(ad_account_id, api):
+    timezone_name = ad_account_timezones.get(ad_account_id)
+    if timezone_name is None:
+        timezone_name = AdAccount(ad_account_id, api=api).api_get(fields=TIMEZONE_FIELDS).get('timezone_name')
+        ad_account_timezones.put(ad_account_id, timezone_name)
+    return timezone_name
+
+# Convert a form date-time ("YYYY-MM-DDTHH:MM", seconds optional) in the ad account's timezone to a UTC string
 def convert_to_utc(local_time_str, ad_account_timezone):
     local_tz = timezone(ad_account_timezone)
-    local_time = local_tz.localize(datetime.strptime(local_time_str, '%Y-%m-%dT%H:%M:%S'))
-    utc_time = local_time.astimezone(timezone('UTC'))
+    local_time = local_tz.localize(datetime.fromisoformat(local_time_str))
+    utc_time = local_time.astimezone(utc)
     return utc_time.strftime('%Y-%m-%dT%H:%M:%S')
 
 
-# Function to create an ad set
-def create_ad_set(campaign_id, folder_name, videos, config, task_id):
-    check_cancellation(task_id)
-    try:
-        app_events = config.get('app_events')
-        gender = config.get("gender", "All")
-        attribution_setting = config.get('attribution_setting', '7d_click')  # Default to '7d_click' if not provided
-        event_type = config.get('event_type', 'PURCHASE')  # Default to 'PURCHASE' if not provided
-        is_cbo = config.get('is_cbo')
-        is_existing_cbo = config.get('is_existing_cbo')
-        ad_account_timezone = config.get('ad_account_timezone')
-
-        try:
-            age_range = json.loads(config.get("age_range", '[18, 65]'))  # Default to '[18, 65]' if not provided
-            age_min = age_range[0]
-            age_max = age_range[1]
+# Build the ad set targeting's platforms and positions from the selected platforms and placements.
+# They are the same for every ad set of a task, so this runs once per task
+def build_placement_targeting(platforms, placements):
+    publisher_platforms = []
+    facebook_positions = []
+    instagram_positions = []
+    audience_network_positions = []
+
+    if platforms.get('facebook'):
+        publisher_platforms.append('facebook')
+        facebook_positions.append('feed')
+        facebook_positions.extend(position for key, position in FACEBOOK_PLACEMENTS if placements.get(key))
+
+    if platforms.get('instagram'):
+        publisher_platforms.append('instagram')
+        instagram_positions.append('stream')
+        instagram_positions.extend(position for key, position in INSTAGRAM_PLACEMENTS if placements.get(key))
+
+    if platforms.get('audience_network'):
+        publisher_platforms.append('audience_network')
+        audience_network_positions.extend(position for key, position in AUDIENCE_NETWORK_PLACEMENTS if placements.get(key))
+        # When Audience Network is selected, also add Facebook and its feeds
+        if 'facebook' not in publisher_platforms:
+            publisher_platforms.append('facebook')
+        facebook_positions.append('feed')
+
+    # Several placements map to the same position, each position is only sent once
+    return {
+        "publisher_platforms": publisher_platforms,
+        "facebook_positions": list(dict.fromkeys(facebook_positions)) or None,
+        "instagram_positions": list(dict.fromkeys(instagram_positions)) or None,
+        "messenger_positions": None,
+        "audience_network_positions": audience_network_positions or None,
+    }
+
+# Build the ad set parameters shared by every ad set of a task, so the form is parsed once per task.
+# Each ad set only adds its name and campaign
+def build_ad_set_template(config):
+    app_events = config.get('app_events')
+    gender = config.get("gender", "All")
+    attribution_setting = config.get('attribution_setting', '7d_click')  # Default to '7d_click' if not provided
+    event_type = config.get('event_type', 'PURCHASE')  # Default to 'PURCHASE' if not provided
+    is_cbo = config.get('is_cbo')
+    is_existing_cbo = config.get('is_existing_cbo')
+    ad_account_timezone = config.get('ad_account_timezone')
 
-        except (ValueError, IndexError):
-            age_min = 18  # Default value if parsing fails
-            age_max = 65  # Default value if parsing fails
+    try:
+        age_range = json.loads(config.get("age_range", '[18, 65]'))  # Default to '[18, 65]' if not provided
+        age_min = age_range[0]
+        age_max = age_range[1]
 
+    except (TypeError, ValueError, IndexError):
+        age_min = 18  # Default value if parsing fails
+        age_max = 65  # Default value if parsing fails
 
 
-        if len(app_events) == 16:
-            app_events += ":00"
 
-        app_events = convert_to_utc(app_events, ad_account_timezone)
+    start_time = convert_to_utc(app_events, ad_account_timezone) if app_events else (datetime.now() + timedelta(days=1)).replace(
+        hour=4, minute=0, second=0, microsecond=0
+    ).strftime('%Y-%m-%dT%H:%M:%S')
 
-        start_time = datetime.strptime(app_events, '%Y-%m-%dT%H:%M:%S') if app_events else (datetime.now() + timedelta(days=1)).replace(
-            hour=4, minute=0, second=0, microsecond=0
-        )
+    if gender == "Male":
+        gender_value = [1]
+    elif gender == "Female":
+        gender_value = [2]
+    else:
+        gender_value = [1, 2]
+
+    # Check for Advantage+ Targeting
+    if config.get('targeting_type') == 'Advantage':
+        # Use Advantage+ targeting settings here
+        ad_set_params = {
+            "billing_event": "IMPRESSIONS",
+            "optimization_goal": config.get("optimization_goal", "OFFSITE_CONVERSIONS"),
+            "targeting_optimization_type": "TARGETING_OPTIMIZATION_ADVANTAGE_PLUS",
+            # Add any other fields required for Advantage+ targeting
+            "targeting": {
+                "geo_locations": {"countries": [config["location"]]},
+            },
+            "start_time": start_time,
+            "dynamic_ad_image_enhancement": True,  # Example: enabling dynamic enhancements
+            "dynamic_ad_voice_enhancement": True,  # Example: enabling dynamic enhancements
+            "promoted_object": {
+                "pixel_id": config["pixel_id"],
+                "custom_event_type": config.get("event_type", "PURCHASE"),
+                "object_store_url": config["object_store_url"] if config["objective"] == "OUTCOME_APP_PROMOTION" else None
+            },
+            # You may need to adjust or add additional parameters here to match Advantage+ targeting requirements
+        }
+    else:
 
-        if gender == "Male":
-            gender_value = [1]
-        elif gender == "Female":
-            gender_value = [2]
-        else:
-            gender_value = [1, 2]
-
-        # Assign placements based on platform selections
-        publisher_platforms = []
-        facebook_positions = []
-        instagram_positions = []
-        messenger_positions = []
-        audience_network_positions = []
-        # Check for Advantage+ Targeting
-        if config.get('targeting_type') == 'Advantage':
-            # Use Advantage+ targeting settings here
-            ad_set_params = {
-                "name": folder_name,
-                "campaign_id": campaign_id,
-                "billing_event": "IMPRESSIONS",
-                "optimization_goal": config.get("optimization_goal", "OFFSITE_CONVERSIONS"),
-                "targeting_optimization_type": "TARGETING_OPTIMIZATION_ADVANTAGE_PLUS",
-                # Add any other fields required for Advantage+ targeting
-                "targeting": {
-                    "geo_locations": {"countries": [config["location"]]},
-                },
-                "start_time": start_time.strftime('%Y-%m-%dT%H:%M:%S'),
-                "dynamic_ad_image_enhancement": True,  # Example: enabling dynamic enhancements
-                "dynamic_ad_voice_enhancement": True,  # Example: enabling dynamic enhancements
-                "promoted_object": {
-                    "pixel_id": config["pixel_id"],
-                    "custom_event_type": config.get("event_type", "PURCHASE"),
-                    "object_store_url": config["object_store_url"] if config["objective"] == "OUTCOME_APP_PROMOTION" else None
-                },
-                # You may need to adjust or add additional parameters here to match Advantage+ targeting requirements
+        ad_set_params = {
+            "billing_event": "IMPRESSIONS",
+            "optimization_goal": config.get("optimization_goal", "OFFSITE_CONVERSIONS"),  # Use the optimization goal from config
+            "targeting": {
+                "geo_locations": {"countries": config["location"]},  # Updated to support multiple countries
+                "age_min": age_min,
+                "age_max": age_max,
+                "genders": gender_value,
+                **config['placement_targeting'],
+                "custom_audiences":config["custom_audiences"],
+                "flexible_spec": [{"interests": [{"id": spec["value"], "name": spec.get("label", "Unknown Interest")}]} for spec in config.get("flexible_spec", [])],  # Use flexible_spec if present
+
+            },
+            "attribution_spec": [
+            {
+                "event_type": 'CLICK_THROUGH',  # Use dynamic event type
+                "window_days": int(attribution_setting.split('_')[0].replace('d', ''))
             }
-        else:
-
-            # Check platform selections and corresponding placements
-            if config['platforms'].get('facebook'):
-                publisher_platforms.append('facebook')
-                facebook_positions.extend([
-                    'feed'
-                ])
-                # Add Facebook placements if selected
-                if config['placements'].get('profile_feed'):
-                    facebook_positions.append('profile_feed')
-                if config['placements'].get('marketplace'):
-                    facebook_positions.append('marketplace')
-                if config['placements'].get('video_feeds'):
-                    facebook_positions.append('video_feeds')
-                if config['placements'].get('right_column'):
-                    facebook_positions.append('right_hand_column')
-                if config['placements'].get('stories'):
-                    facebook_positions.append('story')
-                if config['placements'].get('reels'):
-                    facebook_positions.append('facebook_reels')
-                if config['placements'].get('in_stream'):
-                    facebook_positions.append('instream_video')
-                if config['placements'].get('search'):
-                    facebook_positions.append('search')
-                if config['placements'].get('facebook_reels'):
-                    facebook_positions.append('facebook_reels')
-
-            if config['platforms'].get('instagram'):
-                publisher_platforms.append('instagram')
-                instagram_positions.extend(['stream'])
-
-                # Add Instagram placements if selected
-                if config['placements'].get('instagram_feeds'):
-                    instagram_positions.append('stream')
-                if config['placements'].get('instagram_profile_feed'):
-                    instagram_positions.append('profile_feed')
-                if config['placements'].get('explore'):
-                    instagram_positions.append('explore')
-                if config['placements'].get('explore_home'):
-                    instagram_positions.append('explore_home')
-                if config['placements'].get('instagram_stories'):
-                    instagram_positions.append('story')
-                if config['placements'].get('instagram_reels'):
-                    instagram_positions.append('reels')
-                if config['placements'].get('instagram_search'):
-                    instagram_positions.append('ig_search')
-
-            if config['platforms'].get('audience_network'):
-                publisher_platforms.append('audience_network')
-                # Add Audience Network placements if selected
-                if config['placements'].get('native_banner_interstitial'):
-                    audience_network_positions.append('classic')
-                if config['placements'].get('rewarded_videos'):
-                    audience_network_positions.append('rewarded_video')
-                # When Audience Network is selected, also add Facebook and its feeds
-                if 'facebook' not in publisher_platforms:
-                    publisher_platforms.append('facebook')
-                facebook_positions.extend([
-                    'feed',
-                ])
-
-            # if config['platforms'].get('messenger'):
-            #     publisher_platforms.append('messenger')
-            #     # Add Messenger placements if selected
-            #     if config['placements'].get('messenger_inbox'):
-            #         messenger_positions.append('messenger_home')
-            #     if config['placements'].get('messenger_stories'):
-            #         messenger_positions.append('story')
-            #     if config['placements'].get('messenger_sponsored'):
-            #         messenger_positions.append('sponsored_messages')
-
-            ad_set_params = {
-                "name": folder_name,
-                "campaign_id": campaign_id,
-                "billing_event": "IMPRESSIONS",
-                "optimization_goal": config.get("optimization_goal", "OFFSITE_CONVERSIONS"),  # Use the optimization goal from config
-                "targeting": {
-                    "geo_locations": {"countries": config["location"]},  # Updated to support multiple countries
-                    "age_min": age_min,
-                    "age_max": age_max,
-                    "genders": gender_value,
-                    "publisher_platforms": publisher_platforms,
-                    "facebook_positions": facebook_positions if facebook_positions else None,
-                    "instagram_positions": instagram_positions if instagram_positions else None,
-                    "messenger_positions": messenger_positions if messenger_positions else None,
-                    "audience_network_positions": audience_network_positions if audience_network_positions else None,
-                    "custom_audiences":config["custom_audiences"],
-                    "flexible_spec": [{"interests": [{"id": spec["value"], "name": spec.get("label", "Unknown Interest")}]} for spec in config.get("flexible_spec", [])],  # Use flexible_spec if present
-
-                },
-                "attribution_spec": [
-                {
-                    "event_type": 'CLICK_THROUGH',  # Use dynamic event type
-                    "window_days": int(attribution_setting.split('_')[0].replace('d', ''))
-                }
-                ],
-                "start_time": start_time.strftime('%Y-%m-%dT%H:%M:%S'),
-                "dynamic_ad_image_enhancement": False,
-                "dynamic_ad_voice_enhancement": False,
-                "promoted_object": {
-                    "pixel_id": config["pixel_id"],
-                    "custom_event_type": event_type,  # Use event type from config with default "PURCHASE"
-                    "object_store_url": config["object_store_url"] if config["objective"] == "OUTCOME_APP_PROMOTION" else None
-                }
+            ],
+            "start_time": start_time,
+            "dynamic_ad_image_enhancement": False,
+            "dynamic_ad_voice_enhancement": False,
+            "promoted_object": {
+                "pixel_id": config["pixel_id"],
+                "custom_event_type": event_type,  # Use event type from config with default "PURCHASE"
+                "object_store_url": config["object_store_url"] if config["objective"] == "OUTCOME_APP_PROMOTION" else None
             }
+        }
 
-        # Filter out None values from ad_set_params
-        ad_set_params = {k: v for k, v in ad_set_params.items() if v is not None}
+    # Filter out None values from ad_set_params
+    ad_set_params = {k: v for k, v in ad_set_params.items() if v is not None}
+
+    if config.get('ad_set_bid_strategy') in ['COST_CAP', 'LOWEST_COST_WITH_BID_CAP'] or config.get('bid_strategy') in ['COST_CAP', 'LOWEST_COST_WITH_BID_CAP']:
+        bid_amount_cents = int(float(config['bid_amount']) * 100)  # Convert to cents
+        ad_set_params["bid_amount"] = bid_amount_cents
+
+    if not is_cbo and not is_existing_cbo:
+        if config.get('buying_type') == 'RESERVED':
+            ad_set_params["bid_strategy"] = None
+            ad_set_params["rf_prediction_id"] = config.get('prediction_id')
+        else:
+            ad_set_params["bid_strategy"] = config.get('ad_set_bid_strategy', 'LOWEST_COST_WITHOUT_CAP')
 
         if config.get('ad_set_bid_strategy') in ['COST_CAP', 'LOWEST_COST_WITH_BID_CAP'] or config.get('bid_strategy') in ['COST_CAP', 'LOWEST_COST_WITH_BID_CAP']:
-            bid_amount_cents = int(float(config['bid_amount']) * 100)  # Convert to cents
+            bid_amount_cents = int(float(config['bid_amount']) * 100)
             ad_set_params["bid_amount"] = bid_amount_cents
 
-        if not is_cbo and not is_existing_cbo:
-            if config.get('buying_type') == 'RESERVED':
-                ad_set_params["bid_strategy"] = None
-                ad_set_params["rf_prediction_id"] = config.get('prediction_id')
-            else:
-                ad_set_params["bid_strategy"] = config.get('ad_set_bid_strategy', 'LOWEST_COST_WITHOUT_CAP')
-            
-            if config.get('ad_set_bid_strategy') in ['COST_CAP', 'LOWEST_COST_WITH_BID_CAP'] or config.get('bid_strategy') in ['COST_CAP', 'LOWEST_COST_WITH_BID_CAP']:
-                bid_amount_cents = int(float(config['bid_amount']) * 100)
-                ad_set_params["bid_amount"] = bid_amount_cents
-
-            if config.get('ad_set_budget_optimization') == "DAILY_BUDGET":
-                ad_set_params["daily_budget"] = int(float(config['ad_set_budget_value']) * 100)
-            elif config.get('ad_set_budget_optimization') == "LIFETIME_BUDGET":
-                ad_set_params["lifetime_budget"] = int(float(config['ad_set_budget_value']) * 100)
-                end_time = config.get('ad_set_end_time')
-                if end_time:
-                    if len(end_time) == 16:
-                        end_time += ":00"
-                    end_time = convert_to_utc(end_time, ad_account_timezone)
-                    end_time = datetime.strptime(end_time, '%Y-%m-%dT%H:%M:%S')
-                    ad_set_params["end_time"] = end_time.strftime('%Y-%m-%dT%H:%M:%S')
-        else:
-            if config.get('campaign_budget_optimization') == "LIFETIME_BUDGET":
-                end_time = config.get('ad_set_end_time')
-                if end_time:
-                    if len(end_time) == 16:
-                        end_time += ":00"
-                    end_time = convert_to_utc(end_time, ad_account_timezone)
-                    end_time = datetime.strptime(end_time, '%Y-%m-%dT%H:%M:%S')
-                    ad_set_params["end_time"] = end_time.strftime('%Y-%m-%dT%H:%M:%S')
-
-        print("Ad set parameters before creation:", ad_set_params)
-        ad_set = AdAccount(config['ad_account_id']).create_ad_set(
-            fields=[AdSet.Field.name],
+        if config.get('ad_set_budget_optimization') == "DAILY_BUDGET":
+            ad_set_params["daily_budget"] = int(float(config['ad_set_budget_value']) * 100)
+        elif config.get('ad_set_budget_optimization') == "LIFETIME_BUDGET":
+            ad_set_params["lifetime_budget"] = int(float(config['ad_set_budget_value']) * 100)
+            end_time = config.get('ad_set_end_time')
+            if end_time:
+                ad_set_params["end_time"] = convert_to_utc(end_time, ad_account_timezone)
+    else:
+        if config.get('campaign_budget_optimization') == "LIFETIME_BUDGET":
+            end_time = config.get('ad_set_end_time')
+            if end_time:
+                ad_set_params["end_time"] = convert_to_utc(end_time, ad_account_timezone)
+    return ad_set_params
+
+# Function to create an ad set
+def create_ad_set(campaign_id, folder_name, videos, config, task_id):
+    check_cancellation(task_id)
+    try:
+        ad_set_params = {**config['ad_set_template'], "name": folder_name, "campaign_id": campaign_id}
+        logging.debug("Ad set parameters before creation: %s", ad_set_params)
+        ad_set = config['ad_account'].create_ad_set(
+            fields=AD_SET_FIELDS,
             params=ad_set_params,
         )
-        print(f"Created ad set with ID: {ad_set.get_id()}")
+        logging.info(f"Created ad set with ID: {ad_set.get_id()}")
         return ad_set
     except Exception as e:
         error_msg = f"Error creating ad set: {e}"
@@ -395,26 +565,74 @@ def create_ad_set(campaign_id, folder_name, videos, config, task_id):
         return None
 
 # Helper functions for video and image uploads
+# Fingerprint a media file by its size and first and last MB, scoped to the ad account and upload kind
+def upload_cache_key(kind, media_file, config):
+    try:
+        size = os.path.getsize(media_file)
+        digest = hashlib.blake2b(str(size).encode(), digest_size=16)
+        with open(media_file, 'rb') as f:
+            digest.update(f.read(FINGERPRINT_SAMPLE_SIZE))
+            if size > FINGERPRINT_SAMPLE_SIZE:
+                f.seek(max(size - FINGERPRINT_SAMPLE_SIZE, FINGERPRINT_SAMPLE_SIZE))
+                digest.update(f.read())
+    except OSError as e:
+        logging.warning(f"Could not fingerprint {media_file}, uploading it without the cache: {e}")
+        return None
+    return (kind, config['ad_account_id'], digest.hexdigest())
+
+def get_cached_upload(key):
+    if key is None:
+        return None
+    return upload_cache.get(key)
+
+def cache_upload(key, value):
+    if key is None or not value:
+        return
+    upload_cache.put(key, value)
+
 def upload_video(video_file, task_id, config):
     check_cancellation(task_id)
+    cache_key = upload_cache_key('video', video_file, config)
+    cached_video_id = get_cached_upload(cache_key)
+    if cached_video_id:
+        logging.info(f"Reusing uploaded video {cached_video_id} for {video_file}")
+        return cached_video_id
     try:
-        video = AdVideo(parent_id=config['ad_account_id'])
+        # With a filepath the SDK uploads through the resumable start/transfer/finish
+        # protocol, reading one server-sized chunk at a time rather than the whole file
+        video = AdVideo(parent_id=config['ad_account_id'], api=config['api'])
         video[AdVideo.Field.filepath] = video_file
         video.remote_create()
         video_id = video.get_id()
 
-        # Retry logic to ensure the video is ready
-        for retries in range(10):
+        # Poll until the video is ready, backing off from 1s since most videos are ready within seconds
+        deadline = time.monotonic() + VIDEO_READY_TIMEOUT
+        retries = 0
+        # Waiting on the task's cancel event instead of sleeping lets a cancel end the wait right away
+        cancel_event = cancel_events.get(task_id) or Event()
+        while True:
             try:
-                ready_video = AdVideo(fbid=video_id).api_get(fields=['status'])
-                if ready_video.get('status', {}).get('video_status', 'unknown') == 'ready':
+                ready_video = AdVideo(fbid=video_id, api=config['api']).api_get(fields=['status'])
+                video_status = ready_video.get('status', {}).get('video_status', 'unknown')
+                if video_status == 'ready':
                     logging.info(f"Video {video_id} is ready for use.")
+                    cache_upload(cache_key, video_id)
                     return video_id
+                if video_status == 'error':
+                    # Facebook could not process the video, it will never become ready
+                    logging.error(f"Facebook failed to process video {video_id} from {video_file}.")
+                    return None
             except Exception as retry_error:
                 logging.error(f"Error during retry {retries + 1}: {retry_error}")
-            time.sleep(10)
-
-        logging.error(f"Video {video_id} was not ready after 10 retries.")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if cancel_event.wait(min(VIDEO_READY_MAX_DELAY, 1 << retries, remaining)):
+                logging.warning(f"Task {task_id} was canceled while waiting for video {video_id}.")
+                return None
+            retries += 1
+
+        logging.error(f"Video {video_id} was not ready after {VIDEO_READY_TIMEOUT} seconds.")
         return None
 
     except Exception as e:
@@ -422,343 +640,504 @@ def upload_video(video_file, task_id, config):
         emit_error(task_id, error_msg)
         return None
 
+# Fetch the thumbnail Facebook generated for an uploaded video, preferring the one it marks as preferred
+def get_video_thumbnail_url(video_id, task_id, config):
+    check_cancellation(task_id)
+    try:
+        # The Cursor can only be iterated once, so it is read into a list for both passes below
+        thumbnails = list(AdVideo(video_id, api=config['api']).get_thumbnails(fields=[VideoThumbnail.Field.uri, VideoThumbnail.Field.is_preferred]))
+        uris = [thumbnail.get('uri') for thumbnail in thumbnails if thumbnail.get('is_preferred')] or [thumbnail.get('uri') for thumbnail in thumbnails]
+        return uris[0] if uris else None
+    except Exception as e:
+        logging.error(f"Error fetching thumbnails for video {video_id}: {e}")
+        return None
+
 def upload_image(image_file, task_id, config):
     check_cancellation(task_id)
+    cache_key = upload_cache_key('image', image_file, config)
+    cached_hash = get_cached_upload(cache_key)
+    if cached_hash:
+        logging.info(f"Reusing uploaded image {cached_hash} for {image_file}")
+        return cached_hash
     try:
-        image = AdImage(parent_id=config['ad_account_id'])
+        image = AdImage(parent_id=config['ad_account_id'], api=config['api'])
         image[AdImage.Field.filename] = image_file
         image.remote_create()
         logging.info(f"Uploaded image with hash: {image[AdImage.Field.hash]}")
+        cache_upload(cache_key, image[AdImage.Field.hash])
         return image[AdImage.Field.hash]
     except Exception as e:
         error_msg = f"Error uploading image: {e}"
         emit_error(task_id, error_msg)
         return None
 
-# Function to generate thumbnails for videos
-def generate_thumbnail(video_file, thumbnail_file, task_id):
+# Upload several images in one multipart POST to the ad account, returning their hashes in order
+def upload_images(image_files, task_id, config):
     check_cancellation(task_id)
-    command = ['ffmpeg', '-i', video_file, '-ss', '00:00:01.000', '-vframes', '1', '-update', '1', thumbnail_file]
+    cache_keys = [upload_cache_key('image', image_file, config) for image_file in image_files]
+    hashes = [get_cached_upload(cache_key) for cache_key in cache_keys]
+    # Only images without a cached hash are sent
+    missing = [index for index, image_hash in enumerate(hashes) if not image_hash]
+    if not missing:
+        return hashes
+    # Each part gets a unique name, since the response maps part names to hashes
+    names = {index: f"{index}_{os.path.basename(image_files[index])}" for index in missing}
     try:
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        with tasks_lock:
-            process_pids.setdefault(task_id, []).append(proc.pid)
-        stdout, stderr = proc.communicate()
-
-        if proc.returncode != 0:
-            raise subprocess.CalledProcessError(proc.returncode, command, output=stdout, stderr=stderr)
-
-    except subprocess.CalledProcessError as e:
-        error_msg = f"Error generating thumbnail: {e.cmd} returned non-zero exit status {e.returncode}"
+        with ExitStack() as stack:
+            files = {names[index]: (names[index], stack.enter_context(open(image_files[index], 'rb'))) for index in missing}
+            response = config['api'].call('POST', (config['ad_account_id'], 'adimages'), files=files)
+        images = response.json().get('images', {})
+        for index in missing:
+            hashes[index] = images.get(names[index], {}).get('hash')
+            cache_upload(cache_keys[index], hashes[index])
+        logging.info(f"Uploaded {len(missing)} images in one request")
+        return hashes
+    except Exception as e:
+        error_msg = f"Error uploading images: {e}"
         emit_error(task_id, error_msg)
-        raise
+        return None
 
-def get_video_duration(video_file, task_id):
-    check_cancellation(task_id)
-    command = [
-        'ffprobe',
-        '-v', 'error',
-        '-show_entries', 'format=duration',
-        '-of', 'default=noprint_wrappers=1:nokey=1',
-        video_file
-    ]
+# Input options that decode on the GPU when FFMPEG_HWACCEL names a method this ffmpeg build supports.
+# Probed once; an unset or unsupported method keeps the default CPU decode
+@lru_cache(maxsize=None)
+def ffmpeg_hwaccel_args():
+    if not FFMPEG_HWACCEL:
+        return []
     try:
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        with tasks_lock:
-            if task_id not in process_pids:
-                process_pids[task_id] = []
-            process_pids[task_id].append(proc.pid)
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-hwaccels'], stdin=subprocess.DEVNULL, capture_output=True, text=True, timeout=10)
+        available = result.stdout.split()[3:]  # skip the "Hardware acceleration methods:" header
+    except (OSError, subprocess.SubprocessError) as e:
+        logging.warning(f"Could not probe ffmpeg hardware acceleration, decoding on the CPU: {e}")
+        return []
+    if FFMPEG_HWACCEL not in available:
+        logging.warning(f"ffmpeg does not support hwaccel {FFMPEG_HWACCEL} (available: {available}), decoding on the CPU")
+        return []
+    return ['-hwaccel', FFMPEG_HWACCEL]
+
+# Per-task directory for generated thumbnails, on tmpfs when available since they only live until uploaded
+def make_thumbnail_dir():
+    try:
+        return tempfile.mkdtemp(prefix='fbads-thumbnails-', dir=THUMBNAIL_TMP_DIR)
+    except OSError:
+        return tempfile.mkdtemp(prefix='fbads-thumbnails-')
+
+def new_thumbnail_path(video_file, config):
+    thumbnail_dir = config.get('thumbnail_dir')
+    if thumbnail_dir:
+        return os.path.join(thumbnail_dir, f"{uuid.uuid4().hex}.jpg")
+    return f"{os.path.splitext(video_file)[0]}_thumbnail.jpg"
+
+# Run a task's ffmpeg/ffprobe to completion. The process is only registered while it runs,
+# so a cancel never signals a finished process whose PID the system may have reused
+def run_task_process(command, task_id, **popen_args):
+    proc = subprocess.Popen(command, stdin=subprocess.DEVNULL, **popen_args)
+    with tasks_lock:
+        task_processes.setdefault(task_id, set()).add(proc)
+    try:
+        # A cancel that landed before the process was registered would otherwise miss it
+        if cancel_events.get(task_id, Event()).is_set():
+            proc.terminate()
         stdout, stderr = proc.communicate()
-        if proc.returncode == -signal.SIGTERM:
-            print(f"Process for task {task_id} was terminated.")
-            raise TaskCanceledException(f"Task {task_id} has been canceled")
-        if proc.returncode != 0:
-            raise subprocess.CalledProcessError(proc.returncode, command, output=stdout, stderr=stderr)
-        return float(stdout)
-    except subprocess.CalledProcessError as e:
-        if e.returncode == -signal.SIGTERM:
-            print(f"Process for task {task_id} was terminated by signal.")
-            raise TaskCanceledException(f"Task {task_id} has been canceled")
-        else:
-            print(f"Error getting video duration: {e.cmd} returned non-zero exit status {e.returncode}")
-            print(f"Stdout: {e.output.decode()}")
-            print(f"Stderr: {e.stderr.decode()}")
-            raise
-
-
+    finally:
+        with tasks_lock:
+            task_processes.get(task_id, set()).discard(proc)
+    return proc, stdout, stderr
 
-def trim_video(input_file, output_file, duration, task_id):
+# Function to generate thumbnails for videos
+def generate_thumbnail(video_file, thumbnail_file, task_id):
     check_cancellation(task_id)
-    command = [
-        'ffmpeg',
-        '-i', input_file,
-        '-t', str(duration),
-        '-c', 'copy',
-        output_file
-    ]
+    # A single-frame decode gains little from threads, and many of these run side by side.
+    # Seeking before -i jumps to the nearest keyframe instead of decoding every frame up to 1s,
+    # and the thumbnail output has no audio stream, so the audio is never decoded for it
+    def build_command(hwaccel_args):
+        return ['ffmpeg', '-nostdin', '-threads', FFMPEG_THREADS, *hwaccel_args,
+                '-ss', '00:00:01.000', '-i', video_file, '-vframes', '1', '-an', '-update', '1', thumbnail_file]
+
+    def run(command):
+        # ffmpeg writes the thumbnail to a file and nothing reads its output
+        with ffmpeg_slots:
+            return run_task_process(command, task_id, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
     try:
-        proc = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        with tasks_lock:
-            if task_id not in process_pids:
-                process_pids[task_id] = []
-            process_pids[task_id].append(proc.pid)
-        stdout, stderr = proc.communicate()
-        if proc.returncode == -signal.SIGTERM:
-            print(f"Process for task {task_id} was terminated.")
-            raise TaskCanceledException(f"Task {task_id} has been canceled")
+        hwaccel_args = ffmpeg_hwaccel_args()
+        command = build_command(hwaccel_args)
+        proc, _, _ = run(command)
+
+        # The GPU may not handle every codec or profile, so a failed hardware decode is retried on the CPU
+        if proc.returncode > 0 and hwaccel_args:
+            check_cancellation(task_id)
+            logging.warning(f"Hardware decode of {video_file} failed, retrying on the CPU")
+            command = build_command([])
+            proc, _, _ = run(command)
+
         if proc.returncode != 0:
-            raise subprocess.CalledProcessError(proc.returncode, command, output=stdout, stderr=stderr)
+            raise subprocess.CalledProcessError(proc.returncode, command)
+
     except subprocess.CalledProcessError as e:
-        if e.returncode == -signal.SIGTERM:
-            print(f"Process for task {task_id} was terminated by signal.")
-            raise TaskCanceledException(f"Task {task_id} has been canceled")
-        else:
-            print(f"Error trimming video: {e.cmd} returned non-zero exit status {e.returncode}")
-            print(f"Stdout: {e.output.decode()}")
-            print(f"Stderr: {e.stderr.decode()}")
-            raise
+        error_msg = f"Error generating thumbnail: {e.cmd} returned non-zero exit status {e.returncode}"
+        emit_error(task_id, error_msg)
+        raise
 
 def parse_config(config_text):
     config = {}
-    lines = config_text.strip().split('\n')
-    for line in lines:
-        key, value = line.split(':', 1)
-        config[key.strip()] = value.strip()
+    for line in config_text.splitlines():
+        key, sep, value = line.partition(':')
+        if sep:
+            config[key.strip()] = value.strip()
     return config
 
+# Delete an intermediate file as soon as it is no longer needed, so large batches don't pile up in the upload directory
+def remove_file(file_path):
+    try:
+        os.remove(file_path)
+    except OSError:
+        pass
+
 def convert_webp_to_jpeg(webp_file):
     jpeg_file = os.path.splitext(webp_file)[0] + ".jpg"
     with Image.open(webp_file) as img:
         img.convert("RGB").save(jpeg_file, "JPEG")
     return jpeg_file
 
-def create_ad(ad_set_id, media_file, config, task_id):
+# Graph API accepts at most 50 operations per batch request
+BATCH_LIMIT = 50
+
+# Queues AdCreative + Ad creation for an ad set and sends them as Graph API batch requests
+class AdBatch:
+    # ad_set is a Future for the AdSet (None when creating it failed), so the ads' media can be
+    # prepared and uploaded while the ad set itself is still being created
+    def __init__(self, ad_set, config, task_id):
+        self.ad_set = ad_set
+        self.config = config
+        self.task_id = task_id
+        self.lock = Lock()
+        self.pending = []
+
+    def add(self, ad_name, creative_params):
+        # Each ad costs two operations (creative + ad), flush once the batch is full
+        with self.lock:
+            self.pending.append((ad_name, creative_params))
+            if len(self.pending) * 2 < BATCH_LIMIT:
+                return
+            pending, self.pending = self.pending, []
+        self.execute(pending)
+
+    def flush(self):
+        with self.lock:
+            pending, self.pending = self.pending, []
+        if pending:
+            self.execute(pending)
+
+    # Only read once execute has checked that the ad set was created
+    @property
+    def ad_set_id(self):
+        return self.ad_set.result().get_id()
+
+    # True once the ad set is known to have failed or been canceled, so remaining ads can skip their uploads
+    def ad_set_failed(self):
+        if not self.ad_set.done():
+            return False
+        return self.ad_set.cancelled() or self.ad_set.exception() is not None or not self.ad_set.result()
+
+    def ad_params(self, ad_name, creative_id):
+        return {
+            'name': ad_name,
+            'adset_id': self.ad_set_id,
+            'creative': {'creative_id': creative_id},
+            'status': 'PAUSED',
+        }
+
+    def execute(self, pending):
+        check_cancellation(self.task_id)
+        # process_media cancels the ad set's future when its task stops, and a canceled task
+        # can also end the ad set's creation itself
+        try:
+            ad_set = self.ad_set.result()
+        except (CancelledError, TaskCanceledException):
+            logging.warning(f"Skipping {len(pending)} ads, their ad set was canceled")
+            return
+        if not ad_set:
+            logging.warning(f"Skipping {len(pending)} ads, their ad set could not be created")
+            return
+        ad_account_id = self.config['ad_account_id']
+        api_batch = self.config['api'].new_batch()
+        creative_ids = {}
+        created_ads = set()
+        failed_ads = {}
+
+        # Results are keyed by position, ad names can repeat within an ad set
+        def creative_created(index):
+            def callback(response):
+                creative_ids[index] = response.json().get('id')
+            return callback
+
+        # Graph API answered these, so they are reported rather than sent again. An ad whose creative
+        # failed also fails on the missing reference, keep the creative's error since it names the cause
+        def call_failed(index):
+            def callback(response):
+                failed_ads.setdefault(index, response.error())
+            return callback
+
+        def ad_created(index, ad_name):
+            def callback(response):
+                created_ads.add(index)
+                logging.info(f"Created ad {ad_name} with ID: {response.json().get('id')}")
+            return callback
+
+        # Creatives are referenced by name so each ad picks up the id from the same batch
+        for index, (ad_name, creative_params) in enumerate(pending):
+            creative_call = api_batch.add('POST', (ad_account_id, 'adcreatives'), params=creative_params,
+                                          success=creative_created(index), failure=call_failed(index))
+            creative_call['name'] = f"creative_{index}"
+            creative_call['omit_response_on_success'] = False
+            api_batch.add('POST', (ad_account_id, 'ads'), params=self.ad_params(ad_name, f"{{result=creative_{index}:$.id}}"),
+                          success=ad_created(index, ad_name), failure=call_failed(index))
+
+        try:
+            unfinished = api_batch.execute()
+        except Exception as e:
+            # The batch may have been applied before the error surfaced, and GRAPH_RETRY never repeats
+            # a POST for the same reason, so its ads are reported as failed instead of resent
+            emit_error(self.task_id, f"Error creating {len(pending) - len(created_ads)} ads: {e}")
+            return
+
+        if unfinished:
+            logging.warning(f"{len(unfinished)} batch operations did not complete, retrying their ads on their own")
+
+        # Only ads Graph API never ran go through the regular one-call-per-object path,
+        # reusing a creative the batch already created so it is not duplicated
+        for index, (ad_name, creative_params) in enumerate(pending):
+            if index in created_ads:
+                continue
+            if index in failed_ads:
+                emit_error(self.task_id, f"Error creating ad {ad_name}: {failed_ads[index]}")
+            else:
+                self.create_unbatched(ad_name, creative_params, creative_ids.get(index))
+
+    def create_unbatched(self, ad_name, creative_params, creative_id=None):
+        check_cancellation(self.task_id)
+        try:
+            if not creative_id:
+                creative = self.config['ad_account'].create_ad_creative(params=creative_params)
+                creative_id = creative.get_id()
+            ad = self.config['ad_account'].create_ad(params=self.ad_params(ad_name, creative_id))
+            logging.info(f"Created ad {ad_name} with ID: {ad.get_id()}")
+        except Exception as e:
+            emit_error(self.task_id, f"Error creating ad: {e}")
+
+# Build the parts of the ads' object_story_spec that are the same for every ad of a task
+def build_creative_templates(config):
+    base_link = config.get('link', 'https://kyronaclinic.com/pages/review-1')
+    utm_parameters = config.get('url_parameters', 'utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}')
+
+    if utm_parameters and not utm_parameters.startswith('?'):
+        utm_parameters = '?' + utm_parameters
+
+    link = base_link + utm_parameters
+
+    call_to_action = {
+        "type": config.get('call_to_action', 'SHOP_NOW'),
+        "value": {
+            "link": link
+        }
+    }
+
+    story = {"page_id": config.get('facebook_page_id', '102076431877514')}
+
+    # Carousel cards link with the UTM parameters but keep the bare link on the call to action
+    carousel_card = {
+        "link": link,
+        "call_to_action": {
+            "type": config.get('call_to_action', 'SHOP_NOW'),  # Default to "SHOP_NOW" if not provided
+            "value": {
+                "link": base_link
+            }
+        }
+    }
+
+    # Conditionally add instagram_actor_id
+    if config.get('instagram_actor_id'):
+        story["instagram_actor_id"] = config['instagram_actor_id']
+
+    return {
+        'story': story,
+        'carousel_card': carousel_card,
+        'link_data': {
+            "link": link,  # This is the link to your website or product page
+            "message": config.get('ad_creative_primary_text', 'default text'),
+            "name": config.get('ad_creative_headline', 'Your Headline Here'),
+            "description": config.get('ad_creative_description', 'Your Description Here'),
+            "call_to_action": call_to_action
+        },
+        'video_data': {
+            "call_to_action": call_to_action,
+            "message": config.get('ad_creative_primary_text', 'default text'),
+            "title": config.get('ad_creative_headline', 'No More Neuropathic Foot Pain'),
+            "link_description": config.get('ad_creative_description', 'FREE Shipping & 60-Day Money-Back Guarantee')
+        }
+    }
+
+def create_ad(ad_batch, media_file, config, task_id):
     check_cancellation(task_id)
     try:
+        if ad_batch.ad_set_failed():
+            return
         ad_format = config.get('ad_format', 'Single image or video')
         if ad_format == 'Single image or video':
-            if media_file.lower().endswith('.webp'):
-                print("Converting webp to jpeg")
+            if os.path.splitext(media_file)[1].lower() == '.webp':
+                logging.info("Converting webp to jpeg")
                 media_file = convert_webp_to_jpeg(media_file)
 
-            if media_file.lower().endswith(('.jpg', '.png', '.jpeg')):
-                print("Images")
+            if os.path.splitext(media_file)[1].lower() in IMAGE_EXTS:
+                logging.debug("Images")
                 # Image ad logic
                 image_hash = upload_image(media_file, task_id, config)
                 if not image_hash:
-                    print(f"Failed to upload image: {media_file}")
+                    logging.error(f"Failed to upload image: {media_file}")
                     return
                 
-                base_link = config.get('link', 'https://kyronaclinic.com/pages/review-1')
-                utm_parameters = config.get('url_parameters', 'utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}')
-
-                if utm_parameters and not utm_parameters.startswith('?'):
-                    utm_parameters = '?' + utm_parameters
-                
-                link = base_link + utm_parameters
-
-                call_to_action_type = config.get('call_to_action', 'SHOP_NOW')
-
+                templates = config['creative_templates']
                 object_story_spec = {
-                    "page_id": config.get('facebook_page_id', '102076431877514'),
-                    "link_data": {
-                        "image_hash": image_hash,
-                        "link": link,  # This is the link to your website or product page
-                        "message": config.get('ad_creative_primary_text', 'default text'),
-                        "name": config.get('ad_creative_headline', 'Your Headline Here'),
-                        "description": config.get('ad_creative_description', 'Your Description Here'),
-                        "call_to_action": {
-                            "type": call_to_action_type,
-                            "value": {
-                                "link": link
-                            }
-                        }
-                    }
-                }
-
-                # Conditionally add instagram_actor_id
-                if config.get('instagram_actor_id'):
-                    object_story_spec["instagram_actor_id"] = config['instagram_actor_id']
-                                
-                degrees_of_freedom_spec = {
-                    "creative_features_spec": {
-                        "standard_enhancements": {
-                            "enroll_status": "OPT_OUT"  # explicitly opting out
-                        }
-                    }
+                    **templates['story'],
+                    "link_data": {**templates['link_data'], "image_hash": image_hash}
                 }
 
-                ad_creative = AdCreative(parent_id=config['ad_account_id'])
                 params = {
                     AdCreative.Field.name: "Creative Name",
                     AdCreative.Field.object_story_spec: object_story_spec,
-                    AdCreative.Field.degrees_of_freedom_spec: degrees_of_freedom_spec
+                    AdCreative.Field.degrees_of_freedom_spec: DEGREES_OF_FREEDOM_SPEC
                 }
-                ad_creative.update(params)
-                ad_creative.remote_create()
-
-                ad = Ad(parent_id=config['ad_account_id'])
-                ad[Ad.Field.name] = os.path.splitext(os.path.basename(media_file))[0]
-                ad[Ad.Field.adset_id] = ad_set_id
-                ad[Ad.Field.creative] = {"creative_id": ad_creative.get_id()}
-                ad[Ad.Field.status] = "PAUSED"
-                ad.remote_create()
-
-                print(f"Created image ad with ID: {ad.get_id()}")
+                ad_batch.add(os.path.splitext(os.path.basename(media_file))[0], params)
 
             else:
                 # Video ad logic
                 video_path = media_file
-                thumbnail_path = f"{os.path.splitext(media_file)[0]}.jpg"
-
-                generate_thumbnail(video_path, thumbnail_path, task_id)
-                image_hash = upload_image(thumbnail_path, task_id, config)
-
-                if not image_hash:
-                    print(f"Failed to upload thumbnail: {thumbnail_path}")
-                    return
-
                 video_id = upload_video(video_path, task_id, config)
                 if not video_id:
-                    print(f"Failed to upload video: {media_file}")
+                    logging.error(f"Failed to upload video: {media_file}")
                     return
 
-                base_link = config.get('link', 'https://kyronaclinic.com/pages/review-1')
-                utm_parameters = config.get('url_parameters', 'utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}')
-
-                if utm_parameters and not utm_parameters.startswith('?'):
-                    utm_parameters = '?' + utm_parameters
-
-                link = base_link + utm_parameters
+                # Use the thumbnail Facebook generates for the video, only fall back to ffmpeg when there is none
+                thumbnail = {}
+                thumbnail_url = get_video_thumbnail_url(video_id, task_id, config)
+                if thumbnail_url:
+                    thumbnail["image_url"] = thumbnail_url
+                else:
+                    thumbnail_path = new_thumbnail_path(media_file, config)
+                    generate_thumbnail(video_path, thumbnail_path, task_id)
+                    image_hash = upload_image(thumbnail_path, task_id, config)
+                    # The uploaded frame is only needed by Facebook from here on
+                    remove_file(thumbnail_path)
 
-                call_to_action_type = config.get('call_to_action', 'SHOP_NOW')
+                    if not image_hash:
+                        logging.error(f"Failed to upload thumbnail: {thumbnail_path}")
+                        return
+                    thumbnail["image_hash"] = image_hash
 
+                templates = config['creative_templates']
                 object_story_spec = {
-                    "page_id": config.get('facebook_page_id', '102076431877514'),
-                    "video_data": {
-                        "video_id": video_id,
-                        "call_to_action": {
-                            "type": call_to_action_type,
-                            "value": {
-                                "link": link
-                            }
-                        },
-                        "message": config.get('ad_creative_primary_text', 'default text'),
-                        "title": config.get('ad_creative_headline', 'No More Neuropathic Foot Pain'),
-                        "image_hash": image_hash,
-                        "link_description": config.get('ad_creative_description', 'FREE Shipping & 60-Day Money-Back Guarantee')
-                    }
-                }
-
-                # Conditionally add instagram_actor_id
-                if config.get('instagram_actor_id'):
-                    object_story_spec["instagram_actor_id"] = config['instagram_actor_id']
-                    print("Instagram Actor ID:", config.get('instagram_actor_id'))
-                                
-                degrees_of_freedom_spec = {
-                    "creative_features_spec": {
-                        "standard_enhancements": {
-                            "enroll_status": "OPT_OUT"  # explicitly opting out
-                        }
-                    }
+                    **templates['story'],
+                    "video_data": {**templates['video_data'], "video_id": video_id, **thumbnail}
                 }
 
-                ad_creative = AdCreative(parent_id=config['ad_account_id'])
                 params = {
                     AdCreative.Field.name: "Creative Name",
                     AdCreative.Field.object_story_spec: object_story_spec,
-                    AdCreative.Field.degrees_of_freedom_spec: degrees_of_freedom_spec
+                    AdCreative.Field.degrees_of_freedom_spec: DEGREES_OF_FREEDOM_SPEC
                 }
-                ad_creative.update(params)
-                ad_creative.remote_create()
-
-                ad = Ad(parent_id=config['ad_account_id'])
-                ad[Ad.Field.name] = os.path.splitext(os.path.basename(media_file))[0]
-                ad[Ad.Field.adset_id] = ad_set_id
-                ad[Ad.Field.creative] = {"creative_id": ad_creative.get_id()}
-                ad[Ad.Field.status] = "PAUSED"
-                ad.remote_create()
-
-                print(f"Created video ad with ID: {ad.get_id()}")
+                ad_batch.add(os.path.splitext(os.path.basename(media_file))[0], params)
 
     except TaskCanceledException:
-        print(f"Task {task_id} has been canceled during ad creation.")
+        logging.warning(f"Task {task_id} has been canceled during ad creation.")
     except Exception as e:
         if isinstance(e, subprocess.CalledProcessError) and e.returncode == -signal.SIGTERM:
-            print(f"Task {task_id} process was terminated by signal.")
+            logging.warning(f"Task {task_id} process was terminated by signal.")
         else:
             error_msg = f"Error creating ad: {e}"
             emit_error(task_id, error_msg)
 
-def create_carousel_ad(ad_set_id, media_files, config, task_id):
+def create_carousel_ad(ad_set, media_files, config, task_id):
     check_cancellation(task_id)
     try:
+        ad_batch = AdBatch(ad_set, config, task_id)
+        if ad_batch.ad_set_failed():
+            return
         ad_format = config.get('ad_format', 'Carousel')
         if ad_format == 'Carousel':
             carousel_cards = []
 
-            for media_file in media_files:
-                if media_file.lower().endswith('.webp'):
-                    print("Converting webp to jpeg")
+            # Upload each card's video and use the thumbnail Facebook generates for it. Only cards without
+            # one get an ffmpeg thumbnail, which is then uploaded with the image cards in a single request
+            def prepare_card(media_file):
+                if os.path.splitext(media_file)[1].lower() == '.webp':
+                    logging.info("Converting webp to jpeg")
                     media_file = convert_webp_to_jpeg(media_file)
 
-                if media_file.lower().endswith(('.mp4', '.mov', '.avi')):
-                    # Video processing
-                    video_path = media_file
-                    thumbnail_path = f"{os.path.splitext(media_file)[0]}.jpg"
+                if os.path.splitext(media_file)[1].lower() in VIDEO_EXTS:
+                    video_id = upload_video(media_file, task_id, config)
+                    if not video_id:
+                        return media_file, None, None, None
+                    thumbnail_url = get_video_thumbnail_url(video_id, task_id, config)
+                    if thumbnail_url:
+                        return media_file, None, video_id, thumbnail_url
+                    thumbnail_path = new_thumbnail_path(media_file, config)
+                    generate_thumbnail(media_file, thumbnail_path, task_id)
+                    return media_file, thumbnail_path, video_id, None
+                elif os.path.splitext(media_file)[1].lower() in IMAGE_EXTS:
+                    return media_file, media_file, None, None
+                else:
+                    logging.error(f"Unsupported media file format: {media_file}")
+                    return None
 
-                    generate_thumbnail(video_path, thumbnail_path, task_id)
-                    image_hash = upload_image(thumbnail_path, task_id, config)
+            # Cards are prepared side by side, ffmpeg_slots still bounds how many thumbnails render at once
+            card_futures = [IO_EXECUTOR.submit(prepare_card, media_file) for media_file in media_files]
+            try:
+                # Results are read in submission order, which keeps the cards in the order of the folder
+                card_media = [card for card in (future.result() for future in card_futures) if card]
 
-                    if not image_hash:
-                        print(f"Failed to upload thumbnail: {thumbnail_path}")
+                for media_file, image_path, video_id, thumbnail_url in card_media:
+                    if os.path.splitext(media_file)[1].lower() in VIDEO_EXTS and not video_id:
+                        logging.error(f"Failed to upload video: {media_file}")
                         return
 
-                    video_id = upload_video(video_path, task_id, config)
-                    if not video_id:
-                        print(f"Failed to upload video: {media_file}")
+                image_paths = [image_path for _, image_path, _, _ in card_media if image_path]
+                image_hashes = upload_images(image_paths, task_id, config) if image_paths else []
+            finally:
+                # Every card has to settle first, or one still rendering would leave its thumbnail behind
+                for future in card_futures:
+                    future.cancel()
+                wait(card_futures)
+                for future in card_futures:
+                    if future.cancelled() or future.exception() is not None or not future.result():
+                        continue
+                    media_file, image_path, _, _ = future.result()
+                    if image_path and image_path != media_file:
+                        remove_file(image_path)
+            if image_hashes is None:
+                return
+            hashes_by_path = dict(zip(image_paths, image_hashes))
+
+            card_template = config['creative_templates']['carousel_card']
+            for media_file, image_path, video_id, thumbnail_url in card_media:
+                image_hash = hashes_by_path.get(image_path)
+                if video_id:
+                    # Video processing
+                    if thumbnail_url:
+                        card = {**card_template, "video_id": video_id, "image_url": thumbnail_url}
+                    elif not image_hash:
+                        logging.error(f"Failed to upload thumbnail: {image_path}")
                         return
+                    else:
+                        card = {**card_template, "video_id": video_id, "image_hash": image_hash}
 
-                    card = {
-                        "link": config.get('link', 'https://kyronaclinic.com/pages/review-1'),
-                        "video_id": video_id,
-                        "call_to_action": {
-                            "type": config.get('call_to_action', 'SHOP_NOW'),  # Default to "SHOP_NOW" if not provided
-                            "value": {
-                                "link": config.get('link', 'https://kyronaclinic.com/pages/review-1')
-                            }
-                        },
-                        "image_hash": image_hash
-                    }
-
-                elif media_file.lower().endswith(('.jpg', '.jpeg', '.png')):
+                else:
                     # Image processing
-                    image_hash = upload_image(media_file, task_id, config)
                     if not image_hash:
-                        print(f"Failed to upload image: {media_file}")
+                        logging.error(f"Failed to upload image: {media_file}")
                         return
 
-                    card = {
-                        "link": config.get('link', 'https://kyronaclinic.com/pages/review-1'),
-                        "image_hash": image_hash,
-                        "call_to_action": {
-                            "type": config.get('call_to_action', 'SHOP_NOW'),  # Default to "SHOP_NOW" if not provided
-                            "value": {
-                                "link": config.get('link', 'https://kyronaclinic.com/pages/review-1')
-                            }
-                        }
-                    }
-
-                else:
-                    print(f"Unsupported media file format: {media_file}")
-                    continue
-
-                # Add UTM parameters if provided
-                utm_parameters = config.get('url_parameters', 'utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}')
-                if utm_parameters and not utm_parameters.startswith('?'):
-                    utm_parameters = '?' + utm_parameters
+                    card = {**card_template, "image_hash": image_hash}
 
-                card['link'] += utm_parameters
                 carousel_cards.append(card)
 
             object_story_spec = {
@@ -778,74 +1157,130 @@ def create_carousel_ad(ad_set_id, media_files, config, task_id):
             if config.get('instagram_actor_id'):
                 object_story_spec["instagram_actor_id"] = config['instagram_actor_id']
 
-            degrees_of_freedom_spec = {
-                "creative_features_spec": {
-                    "standard_enhancements": {
-                        "enroll_status": "OPT_OUT"  # explicitly opting out
-                    }
-                }
-            }
 
-            ad_creative = AdCreative(parent_id=config['ad_account_id'])
             params = {
                 AdCreative.Field.name: "Carousel Ad Creative",
                 AdCreative.Field.object_story_spec: object_story_spec,
-                AdCreative.Field.degrees_of_freedom_spec: degrees_of_freedom_spec
+                AdCreative.Field.degrees_of_freedom_spec: DEGREES_OF_FREEDOM_SPEC
             }
-            ad_creative.update(params)
-            ad_creative.remote_create()
-
-            ad = Ad(parent_id=config['ad_account_id'])
-            ad[Ad.Field.name] = "Carousel Ad"
-            ad[Ad.Field.adset_id] = ad_set_id
-            ad[Ad.Field.creative] = {"creative_id": ad_creative.get_id()}
-            ad[Ad.Field.status] = "PAUSED"
-            ad.remote_create()
-
-            print(f"Created carousel ad with ID: {ad.get_id()}")
+            ad_batch.add("Carousel Ad", params)
+            ad_batch.flush()
     except TaskCanceledException:
-        print(f"Task {task_id} has been canceled during carousel ad creation.")
+        logging.warning(f"Task {task_id} has been canceled during carousel ad creation.")
     except Exception as e:
         if isinstance(e, subprocess.CalledProcessError) and e.returncode == -signal.SIGTERM:
-            print(f"Task {task_id} process was terminated by signal.")
+            logging.warning(f"Task {task_id} process was terminated by signal.")
         else:
             error_msg = f"Error creating carousel ad: {e}"
             emit_error(task_id, error_msg)
-            
-def find_campaign_by_id(campaign_id, ad_account_id):
-    try:
-        campaign = AdAccount(ad_account_id).get_campaigns(
-            fields=['name'],
-            params={
-                'filtering': [{'field': 'id', 'operator': 'EQUAL', 'value': campaign_id}]
-            }
-        )
-        if campaign:
-            return campaign_id
+
+# Report a task's progress from one background loop, twice a second and only when it changed,
+# so finishing an ad costs a counter increment instead of a socket emit
+def emit_progress_loop(task_id, progress, total_files, stop_event):
+    last_sent = None
+    percent_per_file = 100 / total_files
+    while not stop_event.is_set():
+        processed = progress['processed']
+        if processed != last_sent:
+            socketio.emit('progress', {'task_id': task_id, 'progress': processed * percent_per_file, 'step': f"{processed}/{total_files}"})
+            last_sent = processed
+        socketio.sleep(0.5)
+
+# Hidden entries and macOS __MACOSX metadata folders hold no real media, only "._name.mp4" stubs
+def is_ignored_entry(entry):
+    return entry.name.startswith('.') or entry.name == '__MACOSX'
+
+# Walk a folder with os.scandir, yielding files with one of the given extensions
+def iter_media_files(directory, extensions):
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if is_ignored_entry(entry):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_media_files(entry.path, extensions)
+            elif os.path.splitext(entry.name)[1].lower() in extensions:
+                yield entry.path
+
+# Split a folder's media into videos and images with a single walk
+def get_all_media_files(directory):
+    video_files, image_files = [], []
+    for media_file in iter_media_files(directory, VIDEO_EXTS | IMAGE_EXTS):
+        if os.path.splitext(media_file)[1].lower() in VIDEO_EXTS:
+            video_files.append(media_file)
         else:
-            return None
-    except Exception as e:
-        print(f"Error finding campaign by ID: {e}")
-        return None
+            image_files.append(media_file)
+    return video_files, image_files
 
-def get_all_video_files(directory):
-    video_files = []
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(('.mp4', '.mov', '.avi')):
-                video_files.append(os.path.join(root, file))
-    return video_files
-
-def get_all_image_files(directory):
-    image_files = []
-    for root, dirs, files in os.walk(directory):
-        for file in files:
-            if file.lower().endswith(('.jpg', '.jpeg', '.png', '.webp')):
-                image_files.append(os.path.join(root, file))
-    return image_files
+# Create the per-task upload directory, under UPLOAD_TMP_DIR when it is set and writable
+def make_upload_dir():
+    if UPLOAD_TMP_DIR:
+        try:
+            return tempfile.mkdtemp(dir=UPLOAD_TMP_DIR)
+        except OSError as e:
+            logging.warning(f"Cannot use {UPLOAD_TMP_DIR} for uploads, falling back to default: {e}")
+    return tempfile.mkdtemp()
+
+# Spool multipart uploads to named files on the staging filesystem instead of anonymous temp files,
+# so save_upload can hard-link them into the task directory rather than copying every byte again
+class UploadRequest(Request):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Named spool files created for this request, keyed by id of the stream handed to FileStorage
+        self.spool_files = {}
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        if filename:
+            try:
+                spool_file = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_TMP_DIR)
+            except OSError:
+                pass
+            else:
+                self.spool_files[id(spool_file)] = spool_file
+                return spool_file
+        return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+
+app.request_class = UploadRequest
+
+# Copy an uploaded file to disk, in the kernel when the upload was spooled to a real file
+def save_upload(file, file_path, spool_files):
+    src = file.stream
+    spool_file = spool_files.get(id(src))
+    # A named spool file is linked into place, it is deleted under its own name when the request ends
+    if spool_file is not None:
+        spool_file.flush()
+        try:
+            os.link(spool_file.name, file_path)
+            return
+        except OSError:
+            pass
+
+    with open(file_path, 'wb') as dst:
+        # Only the named spool files are known to be on disk; anything else may still be held in memory
+        if spool_file is not None:
+            src_fd = spool_file.fileno()
+            offset = spool_file.tell()
+            remaining = os.fstat(src_fd).st_size - offset
+            try:
+                while remaining > 0:
+                    sent = os.sendfile(dst.fileno(), src_fd, offset, remaining)
+                    if sent == 0:
+                        break
+                    offset += sent
+                    remaining -= sent
+                return
+            except OSError:
+                # sendfile leaves the source position untouched, so restart with a plain copy
+                dst.seek(0)
+                dst.truncate()
+
+        shutil.copyfileobj(src, dst, COPY_BUFFER_SIZE)
 
 @app.route('/create_campaign', methods=['POST'])
 def handle_create_campaign():
+    temp_dir = None
+    task_id = None
+    # Once process_media is started, its finally unregisters the task instead
+    started = False
     try:
         config = {}
 
@@ -856,27 +1291,26 @@ def handle_create_campaign():
                 # Extract only the `value` (which is the `id`)
                 return [{"id": audience["value"]} for audience in audiences]
             except json.JSONDecodeError as e:
-                print(f"Error parsing custom audiences: {e}")
+                logging.error(f"Error parsing custom audiences: {e}")
                 return []  # Return an empty list if parsing fails
         try:
             flexible_spec = json.loads(request.form.get("interests", "[]"))
-            print(request.form.get("interests", "[]"))
-            print(f"Flexible Spec: {flexible_spec}")
+            logging.debug("Flexible Spec: %s", flexible_spec)
         except (TypeError, json.JSONDecodeError):
             flexible_spec = []  # Default to an empty list if parsing fails
-            print("Failed to parse flexible_spec")
+            logging.error("Failed to parse flexible_spec")
 
                 
         custom_audiences_str = request.form.get('custom_audiences', '[]')
         custom_audiences = parse_custom_audiences(custom_audiences_str)
-        print(custom_audiences)
+        logging.debug("Custom audiences: %s", custom_audiences)
 
         campaign_name = request.form.get('campaign_name')
         campaign_id = request.form.get('campaign_id')
-        print("campaign id:")
-        print(campaign_id)
+        logging.debug(f"Campaign ID: {campaign_id}")
         upload_folder = request.files.getlist('uploadFolders')
         task_id = request.form.get('task_id')
+        register_task(task_id)
 
         ad_account_id = request.form.get('ad_account_id', 'act_2945173505586523')
         pixel_id = request.form.get('pixel_id', '466400552489809')
@@ -886,9 +1320,7 @@ def handle_create_campaign():
         access_token = request.form.get('access_token', 'EAAEeNcueZAVYBO0NvEUMo378SikOh70zuWuWgimHhnE5Vk7ye8sZCaRtu9qQGWNDvlBZBBnZAT6HCuDlNc4OeOSsdSw5qmhhmtKvrWmDQ8ZCg7a1BZAM1NS69YmtBJWGlTwAmzUB6HuTmb3Vz2r6ig9Xz9ZADDDXauxFCry47Fgh51yS1JCeo295w2V')
         ad_format = request.form.get('ad_format', 'Single image or video')
 
-        print(access_token)
-        print(app_id)
-        print(ad_account_id)
+        logging.debug(f"App ID: {app_id}, ad account ID: {ad_account_id}")
         objective = request.form.get('objective', 'OUTCOME_SALES')
         campaign_budget_optimization = request.form.get('campaign_budget_optimization', 'DAILY_BUDGET')
         budget_value = request.form.get('campaign_budget_value', '50.73')
@@ -918,444 +1350,225 @@ def handle_create_campaign():
                 logging.error(f"Received placements JSON: {placements}")
                 return jsonify({"error": "Invalid placements JSON"}), 400
 
-        logging.info(f"Platforms after processing: {platforms}")
-        logging.info(f"Placements after processing: {placements}")
-        FacebookAdsApi.init(app_id, app_secret, access_token, api_version='v20.0')
-
-        ad_account_timezone = get_ad_account_timezone(ad_account_id)
-
+        # Dicts are only rendered when debug logging is on
+        logging.debug("Platforms after processing: %s", platforms)
+        logging.debug("Placements after processing: %s", placements)
+        api = build_facebook_api(app_id, app_secret, access_token, 'v20.0')
 
-        with tasks_lock:
-            upload_tasks[task_id] = True
-            process_pids[task_id] = []
+        ad_account_timezone = get_ad_account_timezone(ad_account_id, api)
 
         config = {
+            **read_form_config(request.form),
             'ad_account_id': ad_account_id,
             'facebook_page_id': facebook_page_id,
-            'headline': request.form.get('headline', 'No More Neuropathic Foot Pain'),
-            'link': request.form.get('destination_url', 'https://kyronaclinic.com/pages/review-1'),
-            'utm_parameters': request.form.get('url_parameters', '?utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}'),
             'object_store_url': object_store_url,
             'budget_value': budget_value,
             'bid_strategy': bid_strategy,
-            'location': request.form.get('location', 'GB'),
-            'age_range': request.form.get('age_range',),
-            'age_range_max': request.form.get('age_range_max', '65'),
             'pixel_id': pixel_id,
             'objective': objective,
-            'ad_creative_primary_text': request.form.get('ad_creative_primary_text', ''),
-            'ad_creative_headline': request.form.get('ad_creative_headline', 'No More Neuropathic Foot Pain'),
-            'ad_creative_description': request.form.get('ad_creative_description', 'FREE Shipping & 60-Day Money-Back Guarantee'),
-            'call_to_action': request.form.get('call_to_action', 'SHOP_NOW'),
-            'destination_url': request.form.get('destination_url', 'https://kyronaclinic.com/pages/review-1'),
             'app_events': request.form.get('app_events', (datetime.now() + timedelta(days=1)).replace(hour=4, minute=0, second=0, microsecond=0).strftime('%Y-%m-%dT%H:%M:%S')),
-            'language_customizations': request.form.get('language_customizations', 'en'),
-            'url_parameters': request.form.get('url_parameters', '?utm_source=Facebook&utm_medium={{adset.name}}&utm_campaign={{campaign.name}}&utm_content={{ad.name}}'),
-            'gender': request.form.get('gender', 'All'),
-            'ad_set_budget_optimization': request.form.get('ad_set_budget_optimization', 'DAILY_BUDGET'),
-            'ad_set_budget_value': request.form.get('ad_set_budget_value', '50.73'),
-            'ad_set_bid_strategy': request.form.get('ad_set_bid_strategy', 'LOWEST_COST_WITHOUT_CAP'),
-            'campaign_budget_optimization': request.form.get('campaign_budget_optimization', 'AD_SET_BUDGET_OPTIMIZATION'),
             'ad_format': ad_format,
             'bid_amount': bid_amount,
-            'ad_set_end_time': request.form.get('ad_set_end_time', ''),
-            'buying_type': request.form.get('buying_type', 'AUCTION'),
             'platforms': platforms,
             'placements': placements,
             'flexible_spec': flexible_spec,  # Include the parsed flexible_spec
-            'geo_locations': request.form.get('location'),
-            'optimization_goal': request.form.get('performance_goal', 'OFFSITE_CONVERSIONS'),
-            'event_type': request.form.get('event_type', 'PURCHASE'),
-            'is_cbo': request.form.get('isCBO', 'false').lower() == 'true',
+            'is_cbo': is_cbo,
             'custom_audiences': custom_audiences,
-            'attribution_setting': request.form.get('attribution_setting', '7d_click'),
             'ad_account_timezone': ad_account_timezone,
-            'instagram_actor_id': request.form.get('instagram_account', '')
+            'api': api,
         }
 
         if campaign_id:
-            campaign_id = find_campaign_by_id(campaign_id, ad_account_id)
-            existing_campaign_budget_optimization = get_campaign_budget_optimization(campaign_id, ad_account_id)
-            is_existingCBO = existing_campaign_budget_optimization.get('is_campaign_budget_optimization', False)
-            config['is_existing_cbo'] = is_existingCBO
-            if not campaign_id:
-                logging.error(f"Campaign ID {campaign_id} not found for ad account {ad_account_id}")
-                print(campaign_id)
-                print(ad_account_id)
+            existing_campaign = get_campaign_budget_optimization(campaign_id, ad_account_id, api)
+            if not existing_campaign:
                 return jsonify({"error": "Campaign ID not found"}), 404
-        else:
-            print(objective)
-            print("Objective")
-            campaign_id, campaign = create_campaign(campaign_name, objective, campaign_budget_optimization, budget_value, bid_strategy, buying_type, task_id, ad_account_id, app_id, app_secret, access_token, is_cbo)
+            config['is_existing_cbo'] = existing_campaign['is_campaign_budget_optimization']
+
+        config['creative_templates'] = build_creative_templates(config)
+        config['placement_targeting'] = build_placement_targeting(platforms, placements)
+        try:
+            config['ad_set_template'] = build_ad_set_template(config)
+        except Exception as e:
+            emit_error(task_id, f"Error creating ad set: {e}")
+            return jsonify({"error": "Invalid ad set settings"}), 400
+
+        # Only created once the ad set settings are known to be valid, so a bad request leaves no empty campaign
+        if not campaign_id:
+            logging.debug(f"Objective: {objective}")
+            campaign_id, campaign = create_campaign(campaign_name, objective, campaign_budget_optimization, budget_value, bid_strategy, buying_type, task_id, ad_account_id, is_cbo, api)
             if not campaign_id:
                 logging.error(f"Failed to create campaign with name {campaign_name}")
                 return jsonify({"error": "Failed to create campaign"}), 500
 
-        temp_dir = tempfile.mkdtemp()
+        # Shared by every ad set of this task, bound to the task's own API
+        config['ad_account'] = AdAccount(ad_account_id, api=api)
+
+        temp_dir = make_upload_dir()
+        # Many files share a folder, so each directory is only created once
+        created_dirs = set()
         for file in upload_folder:
             file_path = os.path.join(temp_dir, file.filename)
-            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            file_dir = os.path.dirname(file_path)
+            if file_dir not in created_dirs:
+                os.makedirs(file_dir, exist_ok=True)
+                created_dirs.add(file_dir)
             if not file.filename.startswith('.'):  # Skip hidden files like .DS_Store
-                file.save(file_path)
+                save_upload(file, file_path, request.spool_files)
 
-        folders = [f for f in os.listdir(temp_dir) if os.path.isdir(os.path.join(temp_dir, f))]
+        # os.scandir reports entry types from the directory listing, without a stat per entry
+        with os.scandir(temp_dir) as entries:
+            folders = [entry.name for entry in entries if entry.is_dir() and not is_ignored_entry(entry)]
 
-        def has_subfolders(folder):
-            for item in os.listdir(folder):
-                item_path = os.path.join(folder, item)
-                if os.path.isdir(item_path):
-                    return True
-            return False
+        def list_subfolders(folder):
+            with os.scandir(folder) as entries:
+                return [(entry.name, entry.path) for entry in entries if entry.is_dir() and not is_ignored_entry(entry)]
 
+        # Walk the uploads once: one ad set per subfolder, or per top-level folder when it has no subfolders,
+        # with its videos ahead of its images. The totals come from the same walk
+        plan = []
         total_videos = 0
         total_images = 0
         for folder in folders:
             folder_path = os.path.join(temp_dir, folder)
-            total_videos += len(get_all_video_files(folder_path))
-            total_images += len(get_all_image_files(folder_path))
-
-        def process_videos(task_id, campaign_id, folders, config, total_videos):
+            for ad_set_name, ad_set_path in list_subfolders(folder_path) or [(folder, folder_path)]:
+                video_files, image_files = get_all_media_files(ad_set_path)
+                if video_files or image_files:
+                    plan.append((ad_set_name, video_files + image_files))
+                    total_videos += len(video_files)
+                    total_images += len(image_files)
+
+        # Create every ad set up front, submit all of their ads to the shared executor and drain them
+        # in one loop, so ads of different folders overlap instead of waiting on each folder's stragglers
+        def process_media(task_id, campaign_id, plan, config, total_files, media_label):
+            future_to_media = {}
+            ad_set_futures = []
+            progress = {'processed': 0}
+            stop_progress = Event()
+            config['thumbnail_dir'] = make_thumbnail_dir()
             try:
-                socketio.emit('progress', {'task_id': task_id, 'progress': 0, 'step': f"0/{total_videos}"})
-                processed_videos = 0
+                socketio.start_background_task(emit_progress_loop, task_id, progress, total_files, stop_progress)
+                # Ads still running per batch, so each batch is flushed as soon as its last ad is added
+                batch_remaining = {}
 
-                with tqdm(total=total_videos, desc="Processing videos") as pbar:
-                    last_update_time = time.time()
-                    for folder in folders:
+                with tqdm(total=total_files, desc=f"Processing {media_label}", mininterval=1.0, disable=not sys.stderr.isatty()) as pbar:
+                    for ad_set_name, media_files in plan:
                         check_cancellation(task_id)
-                        folder_path = os.path.join(temp_dir, folder)
-
-                        if has_subfolders(folder_path):
-                            for subfolder in os.listdir(folder_path):
-                                subfolder_path = os.path.join(folder_path, subfolder)
-                                if os.path.isdir(subfolder_path):
-                                    video_files = get_all_video_files(subfolder_path)
-                                    if not video_files:
-                                        continue
-
-                                    ad_set = create_ad_set(campaign_id, subfolder, video_files, config, task_id)
-                                    if not ad_set:
-                                        continue
-
-                                    if ad_format == 'Single image or video':
-                                        with ThreadPoolExecutor(max_workers=5) as executor:
-                                            future_to_video = {executor.submit(create_ad, ad_set.get_id(), video, config, task_id): video for video in video_files}
-
-                                            for future in as_completed(future_to_video):
-                                                check_cancellation(task_id)
-                                                video = future_to_video[future]
-                                                try:
-                                                    future.result()
-                                                except TaskCanceledException:
-                                                    logging.warning(f"Task {task_id} has been canceled during processing video {video}.")
-                                                    return
-                                                except Exception as e:
-                                                    logging.error(f"Error processing video {video}: {e}")
-                                                    socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-                                                finally:
-                                                    processed_videos += 1
-                                                    pbar.update(1)
-
-                                                    current_time = time.time()
-                                                    if current_time - last_update_time >= 1:
-                                                        socketio.emit('progress', {'task_id': task_id, 'progress': processed_videos / total_videos * 100, 'step': f"{processed_videos}/{total_videos}"})
-                                                        last_update_time = current_time
-
-                                    elif ad_format == 'Carousel':
-                                        create_carousel_ad(ad_set.get_id(), video_files, config, task_id)
-
-                        else:
-                            video_files = get_all_video_files(folder_path)
-                            if not video_files:
-                                continue
-
-                            ad_set = create_ad_set(campaign_id, folder, video_files, config, task_id)
-                            if not ad_set:
-                                continue
-
-                            if ad_format == 'Single image or video':
-                                with ThreadPoolExecutor(max_workers=5) as executor:
-                                    future_to_video = {executor.submit(create_ad, ad_set.get_id(), video, config, task_id): video for video in video_files}
-
-                                    for future in as_completed(future_to_video):
-                                        check_cancellation(task_id)
-                                        video = future_to_video[future]
-                                        try:
-                                            future.result()
-                                        except TaskCanceledException:
-                                            logging.warning(f"Task {task_id} has been canceled during processing video {video}.")
-                                            return
-                                        except Exception as e:
-                                            logging.error(f"Error processing video {video}: {e}")
-                                            socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-                                        finally:
-                                            processed_videos += 1
-                                            pbar.update(1)
-
-                                            current_time = time.time()
-                                            if current_time - last_update_time >= 0.5:
-                                                socketio.emit('progress', {'task_id': task_id, 'progress': processed_videos / total_videos * 100, 'step': f"{processed_videos}/{total_videos}"})
-                                                last_update_time = current_time
-
-                            elif ad_format == 'Carousel':
-                                create_carousel_ad(ad_set.get_id(), video_files, config, task_id)
-
-                socketio.emit('progress', {'task_id': task_id, 'progress': 100, 'step': f"{total_videos}/{total_videos}"})
-                socketio.emit('task_complete', {'task_id': task_id})
-            except TaskCanceledException:
-                logging.warning(f"Task {task_id} has been canceled during video processing.")
-            except Exception as e:
-                logging.error(f"Error in processing videos: {e}")
-                socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-            finally:
-                with tasks_lock:
-                    process_pids.pop(task_id, None)
-                shutil.rmtree(temp_dir, ignore_errors=True)
+                        # The ad set is created while its ads' media is already being prepared
+                        ad_set = IO_EXECUTOR.submit(create_ad_set, campaign_id, ad_set_name, media_files, config, task_id)
+                        ad_set_futures.append(ad_set)
 
-        def process_images(task_id, campaign_id, folders, config, total_images):
-            try:
-                socketio.emit('progress', {'task_id': task_id, 'progress': 0, 'step': f"0/{total_images}"})
-                processed_images = 0
+                        if config['ad_format'] == 'Single image or video':
+                            ad_batch = AdBatch(ad_set, config, task_id)
+                            batch_remaining[ad_batch] = len(media_files)
+                            for media in media_files:
+                                future_to_media[EXECUTOR.submit(create_ad, ad_batch, media, config, task_id)] = (media, ad_batch)
 
-                with tqdm(total=total_images, desc="Processing images") as pbar:
-                    last_update_time = time.time()
-                    for folder in folders:
-                        check_cancellation(task_id)
-                        folder_path = os.path.join(temp_dir, folder)
-
-                        if has_subfolders(folder_path):
-                            for subfolder in os.listdir(folder_path):
-                                subfolder_path = os.path.join(folder_path, subfolder)
-                                if os.path.isdir(subfolder_path):
-                                    image_files = get_all_image_files(subfolder_path)
-                                    if not image_files:
-                                        continue
-
-                                    ad_set = create_ad_set(campaign_id, subfolder, image_files, config, task_id)
-                                    if not ad_set:
-                                        continue
-
-                                    if config['ad_format'] == 'Single image or video':
-                                        with ThreadPoolExecutor(max_workers=5) as executor:
-                                            future_to_image = {executor.submit(create_ad, ad_set.get_id(), image, config, task_id): image for image in image_files}
-
-                                            for future in as_completed(future_to_image):
-                                                check_cancellation(task_id)
-                                                image = future_to_image[future]
-                                                try:
-                                                    future.result()
-                                                except TaskCanceledException:
-                                                    logging.warning(f"Task {task_id} has been canceled during processing image {image}.")
-                                                    return
-                                                except Exception as e:
-                                                    logging.error(f"Error processing image {image}: {e}")
-                                                    socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-                                                finally:
-                                                    processed_images += 1
-                                                    pbar.update(1)
-
-                                                    current_time = time.time()
-                                                    if current_time - last_update_time >= 1:
-                                                        socketio.emit('progress', {'task_id': task_id, 'progress': processed_images / total_images * 100, 'step': f"{processed_images}/{total_images}"})
-                                                        last_update_time = current_time
-
-                                    elif config['ad_format'] == 'Carousel':
-                                        create_carousel_ad(ad_set.get_id(), image_files, config, task_id)
-
-                        else:
-                            image_files = get_all_image_files(folder_path)
-                            if not image_files:
-                                continue
-
-                            ad_set = create_ad_set(campaign_id, folder, image_files, config, task_id)
-                            if not ad_set:
-                                continue
-
-                            if config['ad_format'] == 'Single image or video':
-                                with ThreadPoolExecutor(max_workers=5) as executor:
-                                    future_to_image = {executor.submit(create_ad, ad_set.get_id(), image, config, task_id): image for image in image_files}
-
-                                    for future in as_completed(future_to_image):
-                                        check_cancellation(task_id)
-                                        image = future_to_image[future]
-                                        try:
-                                            future.result()
-                                        except TaskCanceledException:
-                                            logging.warning(f"Task {task_id} has been canceled during processing image {image}.")
-                                            return
-                                        except Exception as e:
-                                            logging.error(f"Error processing image {image}: {e}")
-                                            socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-                                        finally:
-                                            processed_images += 1
-                                            pbar.update(1)
-
-                                            current_time = time.time()
-                                            if current_time - last_update_time >= 0.5:
-                                                socketio.emit('progress', {'task_id': task_id, 'progress': processed_images / total_images * 100, 'step': f"{processed_images}/{total_images}"})
-                                                last_update_time = current_time
-
-                            elif config['ad_format'] == 'Carousel':
-                                create_carousel_ad(ad_set.get_id(), image_files, config, task_id)
-
-                socketio.emit('progress', {'task_id': task_id, 'progress': 100, 'step': f"{total_images}/{total_images}"})
-                socketio.emit('task_complete', {'task_id': task_id})
-            except TaskCanceledException:
-                logging.warning(f"Task {task_id} has been canceled during image processing.")
-            except Exception as e:
-                logging.error(f"Error in processing images: {e}")
-                socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-            finally:
-                with tasks_lock:
-                    process_pids.pop(task_id, None)
-                shutil.rmtree(temp_dir, ignore_errors=True)
-        
-        def process_mixed_media(task_id, campaign_id, folders, config, total_videos, total_images):
-            try:
-                total_files = total_videos + total_images
-                socketio.emit('progress', {'task_id': task_id, 'progress': 0, 'step': f"0/{total_files}"})
-                processed_files = 0
+                        elif config['ad_format'] == 'Carousel':
+                            create_carousel_ad(ad_set, media_files, config, task_id)
 
-                with tqdm(total=total_files, desc="Processing mixed media") as pbar:
-                    last_update_time = time.time()
-                    for folder in folders:
+                    for future in as_completed(future_to_media):
                         check_cancellation(task_id)
-                        folder_path = os.path.join(temp_dir, folder)
-
-                        # Check if the folder contains subfolders
-                        if has_subfolders(folder_path):
-                            for subfolder in os.listdir(folder_path):
-                                subfolder_path = os.path.join(folder_path, subfolder)
-                                if os.path.isdir(subfolder_path):
-                                    video_files = get_all_video_files(subfolder_path)
-                                    image_files = get_all_image_files(subfolder_path)
-                                    media_files = video_files + image_files
-
-                                    if media_files:
-                                        # Create an ad set for each subfolder
-                                        ad_set = create_ad_set(campaign_id, subfolder, media_files, config, task_id)
-                                        if not ad_set:
-                                            continue
-
-                                        if config['ad_format'] == 'Single image or video':
-                                            with ThreadPoolExecutor(max_workers=5) as executor:
-                                                future_to_media = {executor.submit(create_ad, ad_set.get_id(), media, config, task_id): media for media in media_files}
-
-                                                for future in as_completed(future_to_media):
-                                                    check_cancellation(task_id)
-                                                    media = future_to_media[future]
-                                                    try:
-                                                        future.result()
-                                                    except TaskCanceledException:
-                                                        logging.warning(f"Task {task_id} has been canceled during processing media {media}.")
-                                                        return
-                                                    except Exception as e:
-                                                        logging.error(f"Error processing media {media}: {e}")
-                                                        socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-                                                    finally:
-                                                        processed_files += 1
-                                                        pbar.update(1)
-
-                                                        current_time = time.time()
-                                                        if current_time - last_update_time >= 0.5:
-                                                            socketio.emit('progress', {'task_id': task_id, 'progress': processed_files / total_files * 100, 'step': f"{processed_files}/{total_files}"})
-                                                            last_update_time = current_time
-
-                                        elif config['ad_format'] == 'Carousel':
-                                            create_carousel_ad(ad_set.get_id(), media_files, config, task_id)
-
-                        else:
-                            # Process the folder if no subfolders exist
-                            video_files = get_all_video_files(folder_path)
-                            image_files = get_all_image_files(folder_path)
-                            media_files = video_files + image_files
-
-                            if media_files:
-                                # Create an ad set for the folder
-                                ad_set = create_ad_set(campaign_id, folder, media_files, config, task_id)
-                                if not ad_set:
-                                    continue
-
-                                if config['ad_format'] == 'Single image or video':
-                                    with ThreadPoolExecutor(max_workers=5) as executor:
-                                        future_to_media = {executor.submit(create_ad, ad_set.get_id(), media, config, task_id): media for media in media_files}
-
-                                        for future in as_completed(future_to_media):
-                                            check_cancellation(task_id)
-                                            media = future_to_media[future]
-                                            try:
-                                                future.result()
-                                            except TaskCanceledException:
-                                                logging.warning(f"Task {task_id} has been canceled during processing media {media}.")
-                                                return
-                                            except Exception as e:
-                                                logging.error(f"Error processing media {media}: {e}")
-                                                socketio.emit('error', {'task_id': task_id, 'message': str(e)})
-                                            finally:
-                                                processed_files += 1
-                                                pbar.update(1)
-
-                                                current_time = time.time()
-                                                if current_time - last_update_time >= 0.5:
-                                                    socketio.emit('progress', {'task_id': task_id, 'progress': processed_files / total_files * 100, 'step': f"{processed_files}/{total_files}"})
-                                                    last_update_time = current_time
-
-                                elif config['ad_format'] == 'Carousel':
-                                    create_carousel_ad(ad_set.get_id(), media_files, config, task_id)
-
+                        media, ad_batch = future_to_media[future]
+                        try:
+                            future.result()
+                        except TaskCanceledException:
+                            logging.warning(f"Task {task_id} has been canceled during processing {media}.")
+                            raise
+                        except Exception as e:
+                            logging.error(f"Error processing {media}: {e}")
+                            emit_now('error', {'task_id': task_id, 'message': str(e)})
+
+                        progress['processed'] += 1
+                        pbar.update(1)
+
+                        batch_remaining[ad_batch] -= 1
+                        if not batch_remaining[ad_batch]:
+                            ad_batch.flush()
+
+                stop_progress.set()
                 socketio.emit('progress', {'task_id': task_id, 'progress': 100, 'step': f"{total_files}/{total_files}"})
-                socketio.emit('task_complete', {'task_id': task_id})
-
+                emit_now('task_complete', {'task_id': task_id})
             except TaskCanceledException:
-                logging.warning(f"Task {task_id} has been canceled during mixed media processing.")
+                logging.warning(f"Task {task_id} has been canceled during {media_label} processing.")
             except Exception as e:
-                logging.error(f"Error in processing mixed media: {e}")
-                socketio.emit('error', {'task_id': task_id, 'message': str(e)})
+                logging.error(f"Error in processing {media_label}: {e}")
+                emit_now('error', {'task_id': task_id, 'message': str(e)})
             finally:
-                with tasks_lock:
-                    process_pids.pop(task_id, None)
+                stop_progress.set()
+                # Drop this task's ads that have not started yet from the shared executor, and let
+                # the ones already running finish, since they check the task's cancel event until then
+                task_futures = [*ad_set_futures, *future_to_media]
+                for future in task_futures:
+                    future.cancel()
+                wait(task_futures)
+                unregister_task(task_id)
                 shutil.rmtree(temp_dir, ignore_errors=True)
+                shutil.rmtree(config['thumbnail_dir'], ignore_errors=True)
 
-        
-        
-
-
-        # Call the appropriate processing function based on media types
+        # Label the progress bar based on media types
         if total_videos > 0 and total_images > 0:
-            socketio.start_background_task(target=process_mixed_media, task_id=task_id, campaign_id=campaign_id, folders=folders, config=config, total_videos=total_videos, total_images=total_images)
+            media_label = "mixed media"
         elif total_videos > 0:
-            socketio.start_background_task(target=process_videos, task_id=task_id, campaign_id=campaign_id, folders=folders, config=config, total_videos=total_videos)
-        elif total_images > 0:
-            socketio.start_background_task(target=process_images, task_id=task_id, campaign_id=campaign_id, folders=folders, config=config, total_images=total_images)
+            media_label = "videos"
+        else:
+            media_label = "images"
+
+        if not plan:
+            # No media to process, so no background task will clean up the uploads
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            return jsonify({"message": "Campaign processing started", "task_id": task_id})
+
+        # A cancel that arrived while the request was handled stops the task before any ad is created
+        check_cancellation(task_id)
+        socketio.start_background_task(target=process_media, task_id=task_id, campaign_id=campaign_id, plan=plan, config=config, total_files=total_videos + total_images, media_label=media_label)
+        started = True
 
         return jsonify({"message": "Campaign processing started", "task_id": task_id})
 
+    except TaskCanceledException:
+        logging.warning(f"Task {task_id} was canceled before its media was processed.")
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return jsonify({"message": "Campaign processing canceled", "task_id": task_id})
+    except RequestEntityTooLarge:
+        # Also raised for too many form parts or too much form data in memory, not only MAX_CONTENT_LENGTH
+        logging.error("Upload rejected for exceeding the request size limits")
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return jsonify({"error": "Upload too large"}), 413
     except Exception as e:
         logging.error(f"Error in handle_create_campaign: {e}")
+        if temp_dir:
+            shutil.rmtree(temp_dir, ignore_errors=True)
         return jsonify({"error": "Internal server error"}), 500
+    finally:
+        if not started:
+            unregister_task(task_id)
 
 @app.route('/cancel_task', methods=['POST'])
 def cancel_task():
     try:
         task_id = request.json.get('task_id')
-        print(f"Received request to cancel task: {task_id}")
+        logging.info(f"Received request to cancel task: {task_id}")
+        processes = ()
         with tasks_lock:
-            if task_id in canceled_tasks:
-                print(f"Task {task_id} already marked for cancellation")
-            canceled_tasks.add(task_id)
-            if task_id in upload_tasks:
+            # Only running tasks have an event, so unknown task ids leave nothing behind
+            cancel_event = cancel_events.get(task_id)
+            if cancel_event is None:
+                logging.info(f"Task {task_id} is not running")
+            elif cancel_event.is_set():
+                logging.info(f"Task {task_id} already marked for cancellation")
+            else:
+                cancel_event.set()
                 upload_tasks[task_id] = False
-                # Kill the PIDs associated with this task
-                for pid in process_pids.get(task_id, []):
-                    try:
-                        os.kill(pid, signal.SIGTERM)
-                    except ProcessLookupError:
-                        pass
-                process_pids.pop(task_id, None)
-                print(f"Task {task_id} set to be canceled")
+                processes = task_processes.pop(task_id, ())
+                logging.info(f"Task {task_id} set to be canceled")
+        # Terminate this task's running ffmpeg/ffprobe processes outside the lock, other tasks keep using it
+        for proc in processes:
+            proc.terminate()
         return jsonify({"message": "Task cancellation request processed"}), 200
     except Exception as e:
-        print(f"Error handling cancel task request: {e}")
+        logging.error(f"Error handling cancel task request: {e}")
         return jsonify({"error": "Internal server error"}), 500
     
 @app.route('/get_campaign_budget_optimization', methods=['POST'])
@@ -1371,8 +1584,8 @@ def handle_get_campaign_budget_optimization():
         if not campaign_id or not ad_account_id or not app_id or not app_secret or not access_token:
             return jsonify({"error": "Campaign ID, Ad Account ID, App ID, App Secret, and Access Token are required"}), 400
 
-        FacebookAdsApi.init(app_id, app_secret, access_token, api_version='v19.0')
-        campaign_budget_optimization = is_campaign_budget_optimized(campaign_id, ad_account_id)
+        api = build_facebook_api(app_id, app_secret, access_token, 'v19.0')
+        campaign_budget_optimization = is_campaign_budget_optimized(campaign_id, ad_account_id, api)
 
         if campaign_budget_optimization is not None:
             return jsonify({"campaign_budget_optimization": campaign_budget_optimization}), 200